@@ -12,6 +12,12 @@ class Settings(BaseSettings):
     db_port: int = 6543
     db_name: str = "postgres"
     
+    # Pool de conexiones (valores bajos por el límite de conexiones del pooler)
+    db_pool_size: int = 3
+    db_max_overflow: int = 7
+    db_pool_recycle: int = 300
+    db_pool_timeout: int = 30
+    
     # Seguridad
     secret_key: str
     algorithm: str = "HS256"
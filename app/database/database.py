@@ -11,10 +11,12 @@ logger = logging.getLogger(__name__)
 # ⚠️ CONFIGURACIÓN CRÍTICA PARA WEBSOCKETS
 engine = create_engine(
     settings.database_url,
-    pool_size=3,              # Pocas conexiones persistentes
-    max_overflow=7,           # Hasta 10 conexiones totales (3 + 7)
-    pool_pre_ping=True,       # Verifica que la conexión esté viva
-    pool_recycle=300,         # Recicla cada 5 minutos
+    pool_size=settings.db_pool_size,          # Pocas conexiones persistentes (por defecto 3)
+    max_overflow=settings.db_max_overflow,    # Hasta 10 conexiones totales por defecto (3 + 7)
+    pool_pre_ping=True,                       # Verifica que la conexión esté viva
+    pool_recycle=settings.db_pool_recycle,    # Recicla cada 5 minutos por defecto
+    pool_timeout=settings.db_pool_timeout,    # Espera máxima por una conexión libre antes de fallar
+    query_cache_size=1200,                    # Caché de SQL compilado (default 500)
     echo=settings.debug,
     connect_args={
         "connect_timeout": 10,
@@ -54,4 +56,60 @@ def create_tables():
         logger.info("✅ Tablas creadas exitosamente")
     except SQLAlchemyError as e:
         logger.error(f"❌ Error creando las tablas: {e}")
-        raise
\ No newline at end of file
+        raise
+    preparar_indices_unicos()
+    create_indexes()
+
+# Índices únicos parciales (solo filas no eliminadas): (índice, tabla, dueño, nombre, largo máximo)
+_INDICES_UNICOS_VIGENTES = (
+    ("ix_reminders_user_title", "reminders", "user_id", "title", 100),
+    ("uix_grupo_creador_nombre", "grupos", "creado_por_id", "nombre", 100),
+)
+
+def preparar_indices_unicos():
+    """
+    Deja los datos listos para los índices únicos parciales antes de create_indexes().
+    - Quita una versión anterior del índice que no era parcial (incluía eliminados).
+    - Si el índice aún no existe, renombra los duplicados vigentes agregando " (id)"
+      (se conserva el más antiguo), así se puede crear sin perder datos.
+    """
+    with engine.begin() as conn:
+        for indice, tabla, dueno, nombre, largo in _INDICES_UNICOS_VIGENTES:
+            parcial = conn.execute(
+                text("SELECT indpred IS NOT NULL FROM pg_index WHERE indexrelid = to_regclass(:indice)"),
+                {"indice": indice}
+            ).scalar()
+            if parcial:
+                continue
+            if parcial is False:
+                conn.execute(text(f"DROP INDEX {indice}"))
+                logger.info(f"🧹 Índice {indice} no parcial eliminado, se recrea solo con filas vigentes")
+
+            renombrados = conn.execute(text(f"""
+                UPDATE {tabla} t
+                SET {nombre} = left(t.{nombre}, {largo} - length(' (' || t.id || ')')) || ' (' || t.id || ')'
+                FROM (
+                    SELECT id, row_number() OVER (PARTITION BY {dueno}, {nombre} ORDER BY id) AS n
+                    FROM {tabla}
+                    WHERE is_deleted = false
+                ) d
+                WHERE t.id = d.id AND d.n > 1
+            """)).rowcount
+            if renombrados:
+                logger.warning(f"⚠️ {renombrados} filas duplicadas renombradas en {tabla} antes de crear {indice}")
+
+def create_indexes():
+    """
+    Crea los índices declarados en los modelos que aún no existen.
+    create_all() solo los crea junto con tablas nuevas, no en tablas existentes.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except SQLAlchemyError as e:
+                logger.error(f"❌ Error creando índice {index.name}: {e}")
+                # Los índices únicos sostienen restricciones (p. ej. nombres duplicados):
+                # sin ellos el código aceptaría datos inválidos, así que no se arranca
+                if index.unique:
+                    raise
\ No newline at end of file
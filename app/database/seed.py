@@ -1,13 +1,9 @@
 from sqlalchemy.orm import Session
 from app.usuarios.models import Rol, Usuario, DatosPersonales
-from passlib.context import CryptContext
+from app.usuarios.security import hash_password
 import logging
 
 logger = logging.getLogger(__name__)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
 
 def create_default_roles_and_admin(db: Session):
     roles_por_crear = [
@@ -10,8 +10,8 @@ from sqlalchemy import func, and_, or_
 from ...database.database import SessionLocal
 from ..models import Grupo, MiembroGrupo, Mensaje, LecturaMensaje
 from ...usuarios.models import Usuario
-from ...usuarios.security import get_current_user_ws, SECRET_KEY, ALGORITHM
-from .ws_manager import WebSocketManager, UbicacionManager, grupo_notification_manager
+from ...usuarios.security import get_current_user_ws, SIGNING_KEY, ALGORITHM
+from .ws_manager import WebSocketManager, UbicacionManager, grupo_notification_manager, programar_desde_hilo
 from ...services.fcm_service import fcm_service
 from ...usuarios.models import FCMToken
 
@@ -67,7 +67,7 @@ async def websocket_notificaciones(websocket: WebSocket):
                 return
             
             try:
-                payload = jwt.decode(current_token, SECRET_KEY, algorithms=[ALGORITHM])
+                payload = jwt.decode(current_token, SIGNING_KEY, algorithms=[ALGORITHM])
                 usuario_id = payload.get("id_usuario")
                 
                 if usuario_id is None:
@@ -138,6 +138,7 @@ async def websocket_notificaciones(websocket: WebSocket):
             
             mensajes_entregados_por_grupo = {}
             total_mensajes_marcados = 0
+            ahora_entrega = datetime.now(timezone.utc)
             
             for grupo in grupos_usuario:
                 mensajes_no_entregados = db.query(Mensaje).filter(
@@ -150,7 +151,7 @@ async def websocket_notificaciones(websocket: WebSocket):
                     print(f"📦 Grupo {grupo.id} ({grupo.nombre}): {len(mensajes_no_entregados)} mensajes sin entregar")
                     
                     for mensaje in mensajes_no_entregados:
-                        mensaje.entregado_at = datetime.now(timezone.utc)
+                        mensaje.entregado_at = ahora_entrega
                         total_mensajes_marcados += 1
                     
                     db.commit()
@@ -171,18 +172,16 @@ async def websocket_notificaciones(websocket: WebSocket):
         if mensajes_entregados_por_grupo:
             print(f"📤 Enviando notificaciones de entrega a remitentes...")
             
+            # Un solo frame por grupo, el mismo formato que POST /grupos/{id}/mensajes/marcar-entregados
             for grupo_id, mensaje_ids in mensajes_entregados_por_grupo.items():
-                for mensaje_id in mensaje_ids:
-                    asyncio.create_task(manager.broadcast(grupo_id, {
-                        "type": "mensaje_entregado",
-                        "data": {
-                            "mensaje_id": mensaje_id,
-                            "entregado": True
-                        }
-                    }))
-                    print(f"📬 Notificación de entrega programada para mensaje {mensaje_id}")
-            
-            print(f"✅ {len(sum(mensajes_entregados_por_grupo.values(), []))} notificaciones programadas")
+                await manager.broadcast(grupo_id, {
+                    "type": "mensajes_entregados",
+                    "data": {
+                        "mensaje_ids": mensaje_ids,
+                        "entregado": True
+                    }
+                })
+                print(f"📬 Notificación de entrega enviada para {len(mensaje_ids)} mensajes del grupo {grupo_id}")
         
         await grupo_notification_manager.notify_unread_count_changed(user_id)  # ✅ Usar user_id
         
@@ -196,7 +195,7 @@ async def websocket_notificaciones(websocket: WebSocket):
                 
                 try:
                     if current_token:
-                        payload = jwt.decode(current_token, SECRET_KEY, algorithms=[ALGORITHM])
+                        payload = jwt.decode(current_token, SIGNING_KEY, algorithms=[ALGORITHM])
                         
                         exp_timestamp = payload.get("exp")
                         if exp_timestamp:
@@ -263,7 +262,7 @@ async def websocket_notificaciones(websocket: WebSocket):
                 new_token = payload.get("data", {}).get("token")
                 if new_token:
                     try:
-                        jwt.decode(new_token, SECRET_KEY, algorithms=[ALGORITHM])
+                        jwt.decode(new_token, SIGNING_KEY, algorithms=[ALGORITHM])
                         current_token = new_token
                         print(f"🔔🔄 Token de notificaciones actualizado para usuario {user_id}")  # ✅ Usar user_id
                         await websocket.send_text(json.dumps({
@@ -330,7 +329,7 @@ async def websocket_ubicaciones(websocket: WebSocket, grupo_id: int):
             
             # Validar token
             try:
-                payload = jwt.decode(current_token, SECRET_KEY, algorithms=[ALGORITHM])
+                payload = jwt.decode(current_token, SIGNING_KEY, algorithms=[ALGORITHM])
                 user_id = payload.get("id_usuario")
                 
                 if user_id is None:
@@ -431,7 +430,7 @@ async def websocket_ubicaciones(websocket: WebSocket, grupo_id: int):
                 await asyncio.sleep(60)
                 try:
                     if current_token:
-                        payload = jwt.decode(current_token, SECRET_KEY, algorithms=[ALGORITHM])
+                        payload = jwt.decode(current_token, SIGNING_KEY, algorithms=[ALGORITHM])
                         exp_timestamp = payload.get("exp")
                         if exp_timestamp:
                             ahora = datetime.now(timezone.utc).timestamp()
@@ -513,7 +512,7 @@ async def websocket_ubicaciones(websocket: WebSocket, grupo_id: int):
                 new_token = payload.get("token")
                 if new_token:
                     try:
-                        jwt.decode(new_token, SECRET_KEY, algorithms=[ALGORITHM])
+                        jwt.decode(new_token, SIGNING_KEY, algorithms=[ALGORITHM])
                         current_token = new_token
                         await websocket.send_text(json.dumps({
                             "type": "token_refreshed",
@@ -624,7 +623,6 @@ async def enviar_fcm_en_background(
     
     except Exception as e:
         print(f"❌ Error en FCM background: {e}")
-        import traceback
         traceback.print_exc()
         # ✅ Hacer rollback si hay error
         try:
@@ -747,33 +745,27 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
             if mensajes_no_entregados:
                 print(f"📦 Marcando {len(mensajes_no_entregados)} mensajes como entregados")
                 
+                ahora_entrega = datetime.now(timezone.utc)
                 for mensaje in mensajes_no_entregados:
                     print(f"   📬 Mensaje ID {mensaje.id} de usuario {mensaje.remitente_id}")
-                    mensaje.entregado_at = datetime.now(timezone.utc)
+                    mensaje.entregado_at = ahora_entrega
                 
                 db.commit()
                 print(f"✅ Commit exitoso en base de datos")
                 
-                # 🔥 NOTIFICAR AL REMITENTE - CON DEBUG
-                for mensaje in mensajes_no_entregados:
-                    print(f"📤 Enviando notificación para mensaje {mensaje.id} al grupo {grupo_id}")
-                    
-                    # Verificar si hay usuarios conectados
-                    usuarios_conectados_dict = manager.active_connections.get(grupo_id, {})
-                    usuarios_conectados = len(usuarios_conectados_dict)
-                    print(f"   👥 Usuarios conectados en grupo {grupo_id}: {usuarios_conectados}")
-                    print(f"   👥 IDs conectados: {list(usuarios_conectados_dict.keys())}")
-                    
-                    resultado = await manager.broadcast(grupo_id, {
-                        "type": "mensaje_entregado",
-                        "data": {
-                            "mensaje_id": mensaje.id,
-                            "entregado": True
-                        }
-                    })
-                    
-                    print(f"   {'✅' if resultado else '❌'} Broadcast resultado: {resultado}")
-                    print(f"📬 Notificación enviada para mensaje {mensaje.id}")
+                # Verificar si hay usuarios conectados (una sola vez, sin copiar)
+                usuarios_conectados_dict = manager.active_connections.get(grupo_id, {})
+                print(f"   👥 Usuarios conectados en grupo {grupo_id}: {len(usuarios_conectados_dict)}")
+
+                # 🔥 NOTIFICAR AL REMITENTE: un solo frame con todos los ids (mismo formato que marcar-entregados)
+                resultado = await manager.broadcast(grupo_id, {
+                    "type": "mensajes_entregados",
+                    "data": {
+                        "mensaje_ids": [mensaje.id for mensaje in mensajes_no_entregados],
+                        "entregado": True
+                    }
+                })
+                print(f"   {'✅' if resultado else '❌'} Broadcast resultado: {resultado}")
                 
                 print(f"✅ ════════════════════════════════════════")
                 print(f"✅ TODAS LAS NOTIFICACIONES ENVIADAS")
@@ -782,7 +774,7 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
                 print(f"ℹ️ No hay mensajes pendientes de entrega para usuario {user_id}")
 
             # Notificar contador actualizado
-            await grupo_notification_manager.notify_unread_count_changed(user_id, db)
+            await grupo_notification_manager.notify_unread_count_changed(user_id)
             
         finally:
             db.close()  # ← CERRAR DB después de autenticación
@@ -803,7 +795,7 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
                 await asyncio.sleep(60)
                 try:
                     if current_token:
-                        payload = jwt.decode(current_token, SECRET_KEY, algorithms=[ALGORITHM])
+                        payload = jwt.decode(current_token, SIGNING_KEY, algorithms=[ALGORITHM])
                         
                         exp_timestamp = payload.get("exp")
                         if exp_timestamp:
@@ -874,7 +866,7 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
                 new_token = data.get("token")
                 if new_token:
                     try:
-                        jwt.decode(new_token, SECRET_KEY, algorithms=[ALGORITHM])
+                        jwt.decode(new_token, SIGNING_KEY, algorithms=[ALGORITHM])
                         current_token = new_token
                         print(f"🔄 Token actualizado para usuario {user_id}")
                         await websocket.send_text(json.dumps({
@@ -899,12 +891,13 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
                 db = SessionLocal()
                 try:
                     # 1️⃣ Guardar mensaje en BD
+                    ahora = datetime.now(timezone.utc)
                     mensaje = Mensaje(
                         remitente_id=user_id,
                         grupo_id=grupo_id,
                         contenido=contenido,
                         tipo=tipo,
-                        fecha_creacion=datetime.now(timezone.utc),
+                        fecha_creacion=ahora,
                         entregado_at=None
                     )
                     db.add(mensaje)
@@ -915,7 +908,7 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
                     lectura = LecturaMensaje(
                         mensaje_id=mensaje.id,
                         usuario_id=user_id,
-                        leido_at=datetime.now(timezone.utc)
+                        leido_at=ahora
                     )
                     db.add(lectura)
                     db.commit()
@@ -966,36 +959,20 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
                         }
                     }
 
-                    # 8️⃣ ENVIAR por WebSocket
-                    print(f"📤 Enviando mensaje por WebSocket - temp_id={temp_id}, id_real={mensaje.id}")
-                    print(f"📤 Enviando mensaje por WebSocket - entregado={bool(mensaje.entregado_at)}, leido_por={total_lecturas}")
-                    
-                    # 🔥 BROADCAST (esto enviará el mensaje a todos los conectados)
-                    enviado_exitosamente = await manager.broadcast(grupo_id, out)
-                    
-                    # 🔥 CRÍTICO: Si se entregó exitosamente pero aún no está marcado como entregado en BD
-                    if enviado_exitosamente and not mensaje.entregado_at:
-                        mensaje.entregado_at = datetime.now(timezone.utc)
-                        db.commit()
-                        db.refresh(mensaje)
-                        print(f"📬 Mensaje {mensaje.id} marcado como entregado después del broadcast exitoso")
-                        
-                        # Notificar al remitente que el mensaje fue entregado
-                        await manager.broadcast(grupo_id, {
-                            "type": "mensaje_entregado",
-                            "data": {
-                                "mensaje_id": mensaje.id,
-                                "entregado": True
-                            }
-                        })
-                        print(f"📢 Notificación de entrega enviada para mensaje {mensaje.id}")
+                    # 8️⃣ ENVIAR por WebSocket: a los demás por broadcast y al remitente su eco (con temp_id)
+                    # por su propia cola. Encolar no es entregar: entregado_at solo lo fija el paso 5
+                    # o la confirmación del cliente (marcar-entregados)
+                    await manager.broadcast(grupo_id, out, exclude_user_id=user_id)
+                    manager.send_to_user(grupo_id, user_id, out)
 
-                    # 9️⃣ Actualizar contadores y preparar FCM
+                    # 9️⃣ Programar la actualización de contadores y preparar FCM
+                    await grupo_notification_manager.notify_many(
+                        [miembro_id for miembro_id in miembros_ids if miembro_id != user_id]
+                    )
                     tokens_para_fcm = []
                     
                     for miembro_id in miembros_ids:
                         if miembro_id != user_id:
-                            await grupo_notification_manager.notify_unread_count_changed(miembro_id, db)
                             esta_conectado = manager.is_user_connected_to_group(grupo_id, miembro_id)
                             
                             if esta_conectado:
@@ -1085,39 +1062,16 @@ async def websocket_grupo(websocket: WebSocket, grupo_id: int):
 
 def notify_mensaje_leido_sync(grupo_id: int, mensaje_id: int, leido_por: int):
     """
-    Notifica de forma síncrona que un mensaje fue leído
+    Notifica de forma síncrona que un mensaje fue leído.
+    Se llama desde endpoints síncronos (threadpool): el broadcast se programa en el
+    loop principal, dueño de las colas de cada conexión.
     """
-    import asyncio
-    
-    try:
-        # Obtener el event loop actual si existe
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            # No hay loop, crear uno temporal
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            # Ejecutar y cerrar
-            loop.run_until_complete(manager.broadcast(grupo_id, {
-                "type": "mensaje_leido",
-                "data": {
-                    "mensaje_id": mensaje_id,
-                    "leido_por": leido_por
-                }
-            }))
-            loop.close()
-            return
-        
-        # Si hay loop corriendo, usar create_task
-        asyncio.create_task(manager.broadcast(grupo_id, {
-            "type": "mensaje_leido",
-            "data": {
-                "mensaje_id": mensaje_id,
-                "leido_por": leido_por
-            }
-        }))
-        print(f"📢 Notificación programada: mensaje {mensaje_id} con {leido_por} lecturas")
-    except Exception as e:
-        print(f"⚠️ Error al notificar mensaje leído: {e}")
+    programar_desde_hilo(manager.broadcast(grupo_id, {
+        "type": "mensaje_leido",
+        "data": {
+            "mensaje_id": mensaje_id,
+            "leido_por": leido_por
+        }
+    }))
 
 
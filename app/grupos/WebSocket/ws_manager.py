@@ -2,40 +2,152 @@ from typing import Dict, Set
 from starlette.websockets import WebSocket
 import asyncio
 import json
+import logging
+import orjson
 from ..models import Grupo, MiembroGrupo, Mensaje, LecturaMensaje
+from ...database.database import SessionLocal
 from sqlalchemy.orm import Session
+from sqlalchemy import func, and_, or_, case, distinct
+
+logger = logging.getLogger(__name__)
+
+# Mensajes pendientes por conexión antes de considerarla lenta y desconectarla
+SUBSCRIBER_QUEUE_SIZE = 64
+
+
+# Referencias fuertes a las tareas de fondo: asyncio solo guarda referencias débiles
+# y una tarea sin referencia puede ser recolectada a mitad de ejecución
+_tareas_fondo: Set[asyncio.Task] = set()
+
+
+def _tarea_terminada(task: asyncio.Task):
+    _tareas_fondo.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Error en tarea de WebSocket: %s", task.exception(), exc_info=task.exception())
+
+
+def crear_tarea(coro) -> asyncio.Task:
+    """create_task que conserva la tarea hasta que termina y registra sus excepciones"""
+    task = asyncio.create_task(coro)
+    _tareas_fondo.add(task)
+    task.add_done_callback(_tarea_terminada)
+    return task
+
+
+# Loop principal del servidor: las colas de los Subscriber le pertenecen, así que los
+# endpoints síncronos (threadpool) deben programar ahí sus broadcasts
+_loop_principal: asyncio.AbstractEventLoop | None = None
+
+
+def registrar_loop_principal():
+    """Guarda el loop del servidor; se llama desde el evento startup"""
+    global _loop_principal
+    _loop_principal = asyncio.get_running_loop()
+
+
+def _futuro_terminado(futuro):
+    if not futuro.cancelled() and futuro.exception() is not None:
+        logger.error("❌ Error en tarea programada desde hilo: %s", futuro.exception(), exc_info=futuro.exception())
+
+
+def programar_desde_hilo(coro):
+    """Ejecuta la corrutina en el loop principal desde un hilo del threadpool (sin esperar)"""
+    if _loop_principal is None or _loop_principal.is_closed():
+        coro.close()
+        logger.warning("⚠️ Loop principal no disponible, notificación descartada")
+        return None
+    futuro = asyncio.run_coroutine_threadsafe(coro, _loop_principal)
+    futuro.add_done_callback(_futuro_terminado)
+    return futuro
+
+
+class Subscriber:
+    """
+    Conexión WebSocket registrada con su cola de salida.
+    Una tarea dedicada drena la cola, así un cliente lento no bloquea el broadcast.
+    """
+    __slots__ = ("websocket", "queue", "task")
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.task: asyncio.Task | None = None
+
+    async def stop(self):
+        """Cancela la tarea escritora y espera a que termine (si no es la tarea actual)"""
+        task = self.task
+        if task and task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
 
 class WebSocketManager:
     def __init__(self):
-        # ✅ CAMBIO: Ahora mapea grupo_id -> {user_id -> WebSocket}
-        self.active_connections: Dict[int, Dict[int, WebSocket]] = {}
-        self.lock = asyncio.Lock()
+        # ✅ CAMBIO: Ahora mapea grupo_id -> {user_id -> Subscriber}
+        self.active_connections: Dict[int, Dict[int, Subscriber]] = {}
+        # Sin lock: el event loop es de un solo hilo y las mutaciones no cruzan ningún await
 
     async def connect(self, grupo_id: int, user_id: int, websocket: WebSocket):
         """
         ✅ ACTUALIZADO: Ahora recibe user_id para rastrear quién está conectado
         """
-        async with self.lock:
-            if grupo_id not in self.active_connections:
-                self.active_connections[grupo_id] = {}
-            self.active_connections[grupo_id][user_id] = websocket
-            print(f"✅ Usuario {user_id} conectado al grupo {grupo_id}")
-            print(f"   Total usuarios conectados al grupo: {len(self.active_connections[grupo_id])}")
+        sub = Subscriber(websocket)
+        sub.task = crear_tarea(self._writer(grupo_id, user_id, sub))
+
+        if grupo_id not in self.active_connections:
+            self.active_connections[grupo_id] = {}
+        anterior = self.active_connections[grupo_id].get(user_id)
+        self.active_connections[grupo_id][user_id] = sub
+        logger.debug("✅ Usuario %s conectado al grupo %s", user_id, grupo_id)
+        logger.debug("   Total usuarios conectados al grupo: %s", len(self.active_connections[grupo_id]))
+
+        if anterior:
+            await anterior.stop()
 
     async def disconnect(self, grupo_id: int, user_id: int):
         """
         ✅ ACTUALIZADO: Ahora recibe user_id en lugar de websocket
         """
-        async with self.lock:
-            if grupo_id in self.active_connections:
-                if user_id in self.active_connections[grupo_id]:
-                    del self.active_connections[grupo_id][user_id]
-                    print(f"🔌 Usuario {user_id} desconectado del grupo {grupo_id}")
+        sub = None
+        if grupo_id in self.active_connections:
+            if user_id in self.active_connections[grupo_id]:
+                sub = self.active_connections[grupo_id].pop(user_id)
+                logger.debug("🔌 Usuario %s desconectado del grupo %s", user_id, grupo_id)
                 
-                # Limpiar grupo si no hay usuarios
-                if not self.active_connections[grupo_id]:
-                    del self.active_connections[grupo_id]
-                    print(f"🧹 Grupo {grupo_id} sin usuarios conectados, limpiado")
+            # Limpiar grupo si no hay usuarios
+            if not self.active_connections[grupo_id]:
+                del self.active_connections[grupo_id]
+                logger.debug("🧹 Grupo %s sin usuarios conectados, limpiado", grupo_id)
+
+        if sub:
+            await sub.stop()
+
+    async def _writer(self, grupo_id: int, user_id: int, sub: Subscriber):
+        """Drena la cola de la conexión enviando cada mensaje en orden"""
+        try:
+            while True:
+                mensaje = await sub.queue.get()
+                await sub.websocket.send_text(mensaje)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("   ❌ Error enviando a usuario %s: %s", user_id, e)
+            await self._drop(grupo_id, user_id, sub)
+
+    async def _drop(self, grupo_id: int, user_id: int, sub: Subscriber):
+        """Elimina una conexión fallida o lenta (solo si sigue siendo la registrada)"""
+        grupo_connections = self.active_connections.get(grupo_id)
+        if grupo_connections and grupo_connections.get(user_id) is sub:
+            del grupo_connections[user_id]
+            if not grupo_connections:
+                del self.active_connections[grupo_id]
+            logger.debug("🧹 Usuario %s removido por desconexión", user_id)
+
+        await sub.stop()
+        try:
+            await sub.websocket.close(code=1013, reason="Conexión demasiado lenta")
+        except Exception:
+            pass
 
     def is_user_connected_to_group(self, grupo_id: int, user_id: int) -> bool:
         """
@@ -51,68 +163,63 @@ class WebSocketManager:
 
     async def broadcast(self, grupo_id: int, message: dict, exclude_user_id: int | None = None) -> bool:
         """
-        ✅ ACTUALIZADO: Ahora excluye por user_id en lugar de WebSocket
+        ✅ ACTUALIZADO: Encola el mensaje en cada conexión sin esperar el envío.
+        Las conexiones con la cola llena se desconectan.
         
         Returns:
-            bool: True si al menos un mensaje fue entregado exitosamente
+            bool: True si al menos un mensaje fue encolado exitosamente
         """
-        if grupo_id not in self.active_connections:
-            print(f"⚠️ Grupo {grupo_id} no tiene conexiones activas")
+        grupo_connections = self.active_connections.get(grupo_id)
+        if not grupo_connections:
+            logger.warning("⚠️ Grupo %s no tiene conexiones activas", grupo_id)
             return False  # 🆕 RETORNAR False si no hay conexiones
         
-        # ✅ CRÍTICO: Copiar snapshot FUERA del lock para evitar bloqueos
-        connections_snapshot = {}
-        async with self.lock:
-            grupo_connections = self.active_connections.get(grupo_id, {})
-            
-            # 🔥 CORRECCIÓN DEL BUG: Migrar set a dict si es necesario
-            if isinstance(grupo_connections, set):
-                print(f"🔄 Migrando conexiones del grupo {grupo_id} de set a dict...")
-                new_dict = {}
-                for ws in grupo_connections:
-                    if hasattr(ws, 'usuario_id'):  # Si el websocket tiene usuario_id
-                        new_dict[ws.usuario_id] = ws
-                self.active_connections[grupo_id] = new_dict
-                connections_snapshot = dict(new_dict)
-            elif isinstance(grupo_connections, dict):
-                connections_snapshot = dict(grupo_connections)
-            else:
-                print(f"❌ ERROR: Conexiones del grupo {grupo_id} en formato desconocido: {type(grupo_connections)}")
-                return False  # 🆕 RETORNAR False si hay error
-        
-        if not connections_snapshot:
-            print(f"⚠️ No hay usuarios conectados al grupo {grupo_id} para broadcast")
-            return False  # 🆕 RETORNAR False si no hay usuarios
-        
-        print(f"📤 Broadcasting a {len(connections_snapshot)} usuarios en grupo {grupo_id}")
+        logger.debug("📤 Broadcasting a %s usuarios en grupo %s", len(grupo_connections), grupo_id)
         if exclude_user_id:
-            print(f"   (Excluyendo usuario {exclude_user_id})")
+            logger.debug("   (Excluyendo usuario %s)", exclude_user_id)
         
-        disconnected_users = []
+        # Serializar una sola vez para todos los destinatarios
+        texto = json.dumps(message)
+        lentos = []
         enviados_exitosos = 0
         
-        for user_id, websocket in connections_snapshot.items():
+        # Sin await dentro del bucle: no hay cambios de contexto mientras se itera
+        for user_id, sub in grupo_connections.items():
             if user_id == exclude_user_id:
-                print(f"   ⏭️ Saltando usuario {user_id} (remitente)")
                 continue
             
             try:
-                await websocket.send_text(json.dumps(message))
+                sub.queue.put_nowait(texto)
                 enviados_exitosos += 1
-                print(f"   ✅ Mensaje enviado a usuario {user_id}")
-            except Exception as e:
-                print(f"   ❌ Error enviando a usuario {user_id}: {e}")
-                disconnected_users.append(user_id)
+            except asyncio.QueueFull:
+                logger.warning("   ⚠️ Cola llena para usuario %s, desconectando", user_id)
+                lentos.append((user_id, sub))
         
-        print(f"📊 Broadcast completado: {enviados_exitosos} exitosos, {len(disconnected_users)} fallidos")
+        logger.debug("📊 Broadcast completado: %s encolados, %s descartados", enviados_exitosos, len(lentos))
         
-        # Limpiar usuarios desconectados
-        if disconnected_users:
-            async with self.lock:
-                for user_id in disconnected_users:
-                    if grupo_id in self.active_connections:
-                        self.active_connections[grupo_id].pop(user_id, None)
-                        print(f"🧹 Usuario {user_id} removido por desconexión")
+        for user_id, sub in lentos:
+            crear_tarea(self._drop(grupo_id, user_id, sub))
+
+        return enviados_exitosos > 0
+
+    def send_to_user(self, grupo_id: int, user_id: int, message: dict) -> bool:
+        """
+        Encola un mensaje solo para un usuario del grupo (misma cola que el broadcast,
+        así conserva el orden respecto a los demás frames).
+        
+        Returns:
+            bool: True si el mensaje fue encolado
+        """
+        sub = self.active_connections.get(grupo_id, {}).get(user_id)
+        if not sub:
+            return False
+        try:
+            sub.queue.put_nowait(json.dumps(message))
+            return True
+        except asyncio.QueueFull:
+            logger.warning("   ⚠️ Cola llena para usuario %s, desconectando", user_id)
+            crear_tarea(self._drop(grupo_id, user_id, sub))
+            return False
     
     def get_connected_users(self, grupo_id: int) -> list[int]:
         """
@@ -126,85 +233,152 @@ class WebSocketManager:
         return []
 
 
+# Ventana para agrupar las ubicaciones de un grupo en un solo frame
+UBICACION_BATCH_SECONDS = 0.1
+
+
 class UbicacionManager:
     def __init__(self):
-        self.active_locations: dict[int, dict[int, WebSocket]] = {}
+        self.active_locations: dict[int, dict[int, Subscriber]] = {}
         self.ubicaciones: dict[int, dict[int, dict]] = {}
+        # Solo protege las secciones que cierran la conexión anterior (cruzan un await)
         self.lock = asyncio.Lock()
+        # Ubicaciones pendientes de envío: grupo_id -> user_id -> última ubicación
+        self._pending: dict[int, dict[int, dict]] = {}
 
     async def force_disconnect_if_exists(self, grupo_id: int, user_id: int):
         """Fuerza el cierre de una conexión existente ANTES de accept()"""
         async with self.lock:
             if grupo_id in self.active_locations and user_id in self.active_locations[grupo_id]:
-                old_ws = self.active_locations[grupo_id][user_id]
+                old_sub = self.active_locations[grupo_id][user_id]
+                await old_sub.stop()
                 try:
-                    await old_ws.close(code=1000, reason="Nueva conexión solicitada")
-                    print(f"🔄 Conexión zombie cerrada para usuario {user_id} en grupo {grupo_id}")
+                    await old_sub.websocket.close(code=1000, reason="Nueva conexión solicitada")
+                    logger.debug("🔄 Conexión zombie cerrada para usuario %s en grupo %s", user_id, grupo_id)
                 except Exception as e:
-                    print(f"⚠️ Error cerrando zombie: {e}")
+                    logger.warning("⚠️ Error cerrando zombie: %s", e)
                 finally:
                     self.active_locations[grupo_id].pop(user_id, None)
                     if not self.active_locations[grupo_id]:
                         del self.active_locations[grupo_id]
     
     async def connect_ubicacion(self, grupo_id: int, user_id: int, websocket: WebSocket):
+        sub = Subscriber(websocket)
+        sub.task = crear_tarea(self._writer(grupo_id, user_id, sub))
+
         async with self.lock:
             if grupo_id not in self.active_locations:
                 self.active_locations[grupo_id] = {}
             
             # 🔥 SI YA HAY CONEXIÓN, CERRARLA ANTES
             if user_id in self.active_locations[grupo_id]:
-                old_ws = self.active_locations[grupo_id][user_id]
+                old_sub = self.active_locations[grupo_id][user_id]
+                await old_sub.stop()
                 try:
-                    await old_ws.close(code=1000, reason="Nueva conexión establecida")
-                    print(f"🔄 Conexión anterior cerrada para usuario {user_id} en grupo {grupo_id}")
+                    await old_sub.websocket.close(code=1000, reason="Nueva conexión establecida")
+                    logger.debug("🔄 Conexión anterior cerrada para usuario %s en grupo %s", user_id, grupo_id)
                 except Exception as e:
-                    print(f"⚠️ Error al cerrar conexión anterior: {e}")
+                    logger.warning("⚠️ Error al cerrar conexión anterior: %s", e)
             
             # Registrar nueva conexión
-            self.active_locations[grupo_id][user_id] = websocket
-            print(f"✅ Usuario {user_id} conectado a ubicaciones del grupo {grupo_id}")
-            print(f"   Total usuarios conectados al grupo: {len(self.active_locations[grupo_id])}")
+            self.active_locations[grupo_id][user_id] = sub
+            logger.debug("✅ Usuario %s conectado a ubicaciones del grupo %s", user_id, grupo_id)
+            logger.debug("   Total usuarios conectados al grupo: %s", len(self.active_locations[grupo_id]))
     
     async def disconnect_ubicacion(self, grupo_id: int, user_id: int):
-        async with self.lock:
-            if grupo_id in self.active_locations:
-                self.active_locations[grupo_id].pop(user_id, None)
-                if not self.active_locations[grupo_id]:
-                    del self.active_locations[grupo_id]
+        sub = None
+        if grupo_id in self.active_locations:
+            sub = self.active_locations[grupo_id].pop(user_id, None)
+            if not self.active_locations[grupo_id]:
+                del self.active_locations[grupo_id]
             
-            # Limpiar ubicación
-            if grupo_id in self.ubicaciones:
-                self.ubicaciones[grupo_id].pop(user_id, None)
+        # Limpiar ubicación
+        if grupo_id in self.ubicaciones:
+            self.ubicaciones[grupo_id].pop(user_id, None)
             
-            print(f"📍 Usuario {user_id} desconectado de ubicaciones del grupo {grupo_id}")
+        logger.debug("📍 Usuario %s desconectado de ubicaciones del grupo %s", user_id, grupo_id)
+
+        if sub:
+            await sub.stop()
+
+    async def _writer(self, grupo_id: int, user_id: int, sub: Subscriber):
+        """Drena la cola de ubicaciones de la conexión"""
+        try:
+            while True:
+                mensaje = await sub.queue.get()
+                await sub.websocket.send_text(mensaje)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await self._drop(grupo_id, user_id, sub)
+
+    async def _drop(self, grupo_id: int, user_id: int, sub: Subscriber):
+        """Elimina una conexión fallida o lenta (solo si sigue siendo la registrada)"""
+        grupo_locations = self.active_locations.get(grupo_id)
+        if grupo_locations and grupo_locations.get(user_id) is sub:
+            del grupo_locations[user_id]
+            if not grupo_locations:
+                del self.active_locations[grupo_id]
+
+        await sub.stop()
+        try:
+            await sub.websocket.close(code=1013, reason="Conexión demasiado lenta")
+        except Exception:
+            pass
     
     async def broadcast_ubicacion(self, grupo_id: int, user_id: int, data: dict):
-        """Envía la ubicación a todos los miembros del grupo"""
-        async with self.lock:
-            # Guardar ubicación en memoria
-            if grupo_id not in self.ubicaciones:
-                self.ubicaciones[grupo_id] = {}
-            
-            self.ubicaciones[grupo_id][user_id] = data
-            
-            # Broadcast a todos los conectados del grupo
-            if grupo_id in self.active_locations:
-                mensaje = json.dumps({
-                    "type": "ubicacion_update",
-                    "user_id": user_id,
-                    "nombre": data["nombre"],
-                    "lat": data["lat"],
-                    "lon": data["lon"],
-                    "timestamp": data["timestamp"],
-                    "es_creador": data.get("es_creador", False)
-                })
-                
-                for uid, ws in self.active_locations[grupo_id].items():
-                    try:
-                        await ws.send_text(mensaje)
-                    except:
-                        pass
+        """
+        Envía la ubicación a todos los miembros del grupo.
+        
+        Las ubicaciones que llegan dentro de UBICACION_BATCH_SECONDS se agrupan
+        en un solo frame "ubicacion_bulk" por receptor (solo la última de cada usuario).
+        """
+        # Guardar ubicación en memoria
+        if grupo_id not in self.ubicaciones:
+            self.ubicaciones[grupo_id] = {}
+        
+        self.ubicaciones[grupo_id][user_id] = data
+        
+        if grupo_id not in self.active_locations:
+            return
+
+        pendientes = self._pending.get(grupo_id)
+        if pendientes is None:
+            pendientes = self._pending[grupo_id] = {}
+            crear_tarea(self._flush_later(grupo_id))
+
+        pendientes[user_id] = {
+            "user_id": user_id,
+            "nombre": data["nombre"],
+            "lat": data["lat"],
+            "lon": data["lon"],
+            "timestamp": data["timestamp"],
+            "es_creador": data.get("es_creador", False)
+        }
+
+    async def _flush_later(self, grupo_id: int):
+        """Espera la ventana de agrupación y envía las ubicaciones acumuladas"""
+        await asyncio.sleep(UBICACION_BATCH_SECONDS)
+        pendientes = self._pending.pop(grupo_id, None)
+
+        grupo_locations = self.active_locations.get(grupo_id)
+        if not pendientes or not grupo_locations:
+            return
+
+        mensaje = json.dumps({
+            "type": "ubicacion_bulk",
+            "updates": list(pendientes.values())
+        })
+        
+        lentos = []
+        for uid, sub in grupo_locations.items():
+            try:
+                sub.queue.put_nowait(mensaje)
+            except asyncio.QueueFull:
+                lentos.append((uid, sub))
+
+        for uid, sub in lentos:
+            crear_tarea(self._drop(grupo_id, uid, sub))
     
     def get_ubicaciones_grupo(self, grupo_id: int) -> dict:
         """Obtiene todas las ubicaciones activas de un grupo"""
@@ -212,107 +386,147 @@ class UbicacionManager:
 
 ubicacion_manager = UbicacionManager()
 
+# Ventana para agrupar ráfagas de cambios de no leídos de un mismo usuario
+NOTIFY_DEBOUNCE_SECONDS = 0.15
+
+
 class GrupoNotificationManager:
     def __init__(self):
         # Mapea user_id -> WebSocket para notificaciones globales
         self.user_connections: Dict[int, WebSocket] = {}
-        self.lock = asyncio.Lock()
+        # Notificaciones programadas: user_id -> timer pendiente
+        self._pending: Dict[int, asyncio.TimerHandle] = {}
+        # Hash del último conteo enviado: user_id -> hash (solo se envían cambios)
+        self._last_hash: Dict[int, int] = {}
     
     async def connect_user(self, user_id: int, websocket: WebSocket):
         """Conecta un usuario para recibir notificaciones globales"""
-        async with self.lock:
-            self.user_connections[user_id] = websocket
-            print(f"🔔 Usuario {user_id} conectado a notificaciones globales")
+        self.user_connections[user_id] = websocket
+        # Una conexión nueva siempre recibe el conteo completo
+        self._last_hash.pop(user_id, None)
+        logger.debug("🔔 Usuario %s conectado a notificaciones globales", user_id)
     
     async def disconnect_user(self, user_id: int):
         """Desconecta un usuario de notificaciones globales"""
-        async with self.lock:
-            self.user_connections.pop(user_id, None)
-            print(f"🔔 Usuario {user_id} desconectado de notificaciones globales")
+        self.user_connections.pop(user_id, None)
+        self._last_hash.pop(user_id, None)
+        logger.debug("🔔 Usuario %s desconectado de notificaciones globales", user_id)
     
     async def is_user_connected(self, user_id: int) -> bool:
         """
         ⚠️ DEPRECATED: Este método solo verifica notificaciones globales
         Usar manager.is_user_connected_to_group() para verificar conexión al grupo
         """
-        async with self.lock:
-            return user_id in self.user_connections
+        return user_id in self.user_connections
     
-    async def notify_unread_count_changed(self, user_id: int, db: Session = None):
+    async def notify_unread_count_changed(self, user_id: int):
+        """
+        Programa la notificación de cambios en mensajes no leídos a un usuario.
+        
+        Las llamadas que llegan dentro de NOTIFY_DEBOUNCE_SECONDS se agrupan en
+        un solo recálculo y un solo frame, que se envía al cerrar la ventana.
         """
-        Notifica a un usuario específico sobre cambios en mensajes no leídos.
+        if user_id not in self.user_connections or user_id in self._pending:
+            return
         
-        ⚠️ IMPORTANTE: Si no se proporciona 'db', se crea una sesión temporal
-        que se cierra automáticamente. Esto es CRÍTICO para WebSockets.
+        loop = asyncio.get_running_loop()
+        self._pending[user_id] = loop.call_later(
+            NOTIFY_DEBOUNCE_SECONDS,
+            lambda: crear_tarea(self._do_notify(user_id))
+        )
+    
+    async def notify_many(self, user_ids: list[int]):
+        """
+        Programa la notificación de no leídos para varios usuarios.
+        Solo agenda el debounce de cada uno (no espera el recálculo), por eso basta un bucle.
         """
+        for uid in user_ids:
+            await self.notify_unread_count_changed(uid)
+    
+    async def _do_notify(self, user_id: int):
+        """
+        Calcula y envía el conteo de no leídos por grupo.
+        
+        La consulta se ejecuta en un hilo con su propia sesión para no
+        bloquear el event loop.
+        """
+        self._pending.pop(user_id, None)
+        
         websocket = self.user_connections.get(user_id)
         if not websocket:
             return
         
-        # 🔥 CLAVE: Crear sesión temporal si no se proporciona
-        should_close_db = False
-        if db is None:
-            from ...database.database import SessionLocal
-            db = SessionLocal()
-            should_close_db = True
-        
         try:
-            # Calcular mensajes no leídos por grupo
-            from sqlalchemy import func, and_, or_
+            # La BD es la fuente de verdad (una sola consulta agregada): el conteo es
+            # correcto sin importar qué worker o qué camino (REST o WS) marcó la lectura
+            grupos_no_leidos = await asyncio.to_thread(contar_no_leidos_por_grupo, user_id)
             
-            grupos_query = (
-                db.query(Grupo)
-                .outerjoin(MiembroGrupo, and_(
-                    MiembroGrupo.grupo_id == Grupo.id,
-                    MiembroGrupo.usuario_id == user_id,
-                    MiembroGrupo.activo == True
-                ))
-                .filter(
-                    Grupo.is_deleted == False,
-                    or_(
-                        Grupo.creado_por_id == user_id,
-                        MiembroGrupo.id != None
-                    )
-                )
-                .all()
-            )
+            # Enviar solo si el conteo cambió desde el último envío
+            h = hash(tuple((g["grupo_id"], g["mensajes_no_leidos"]) for g in grupos_no_leidos))
+            if self._last_hash.get(user_id) == h:
+                return
             
-            grupos_no_leidos = []
-            for grupo in grupos_query:
-                count = (
-                    db.query(func.count(Mensaje.id))
-                    .outerjoin(LecturaMensaje, and_(
-                        LecturaMensaje.mensaje_id == Mensaje.id,
-                        LecturaMensaje.usuario_id == user_id
-                    ))
-                    .filter(
-                        Mensaje.grupo_id == grupo.id,
-                        Mensaje.remitente_id != user_id,
-                        LecturaMensaje.id == None
-                    )
-                    .scalar() or 0
-                )
-                
-                grupos_no_leidos.append({
-                    "grupo_id": grupo.id,
-                    "mensajes_no_leidos": count
-                })
-            
-            # Enviar notificación
-            await websocket.send_text(json.dumps({
+            payload = orjson.dumps({
                 "type": "unread_count_update",
                 "data": grupos_no_leidos
-            }))
-            print(f"📊 Enviado conteo de no leídos a usuario {user_id}")
+            }).decode()
+            
+            await websocket.send_text(payload)
+            self._last_hash[user_id] = h
+            logger.debug("📊 Enviado conteo de no leídos a usuario %s", user_id)
             
         except Exception as e:
-            print(f"❌ Error al notificar usuario {user_id}: {e}")
+            logger.error("❌ Error al notificar usuario %s: %s", user_id, e)
             await self.disconnect_user(user_id)
+
+
+def contar_no_leidos_por_grupo(user_id: int) -> list[dict]:
+    """
+    Cuenta los mensajes no leídos del usuario en cada uno de sus grupos
+    con una sola consulta agregada.
+    
+    ⚠️ IMPORTANTE: Usa una sesión temporal propia que se cierra al terminar.
+    Esto es CRÍTICO para WebSockets.
+    """
+    db = SessionLocal()
+    try:
+        filas = (
+            db.query(
+                Grupo.id,
+                func.count(distinct(case((LecturaMensaje.id == None, Mensaje.id))))
+            )
+            .outerjoin(MiembroGrupo, and_(
+                MiembroGrupo.grupo_id == Grupo.id,
+                MiembroGrupo.usuario_id == user_id,
+                MiembroGrupo.activo == True
+            ))
+            .outerjoin(Mensaje, and_(
+                Mensaje.grupo_id == Grupo.id,
+                Mensaje.remitente_id != user_id
+            ))
+            .outerjoin(LecturaMensaje, and_(
+                LecturaMensaje.mensaje_id == Mensaje.id,
+                LecturaMensaje.usuario_id == user_id
+            ))
+            .filter(
+                Grupo.is_deleted == False,
+                or_(
+                    Grupo.creado_por_id == user_id,
+                    MiembroGrupo.id != None
+                )
+            )
+            .group_by(Grupo.id)
+            .order_by(Grupo.id)
+            .all()
+        )
         
-        finally:
-            # 🔥 CRÍTICO: Cerrar sesión si la creamos nosotros
-            if should_close_db:
-                db.close()
+        return [
+            {"grupo_id": grupo_id, "mensajes_no_leidos": count or 0}
+            for grupo_id, count in filas
+        ]
+    finally:
+        # 🔥 CRÍTICO: Cerrar la sesión temporal
+        db.close()
 
 # Instancia global
 grupo_notification_manager = GrupoNotificationManager()
\ No newline at end of file
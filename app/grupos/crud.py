@@ -1,18 +1,16 @@
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import and_
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from fastapi import HTTPException
 from datetime import datetime
+from cachetools import TTLCache
 import secrets
+import threading
 
 from .models import Grupo, MiembroGrupo
 
 def create_grupo(db: Session, grupo_data, user_id: int):
     try:
-        # Verificar si ya existe un grupo con el mismo nombre creado por el mismo usuario
-        existing = db.query(Grupo).filter_by(nombre=grupo_data.nombre, creado_por_id=user_id, is_deleted=False).first()
-        if existing:
-            raise HTTPException(status_code=400, detail="Ya tienes un grupo con ese nombre")
-
         # Generar código de invitación aleatorio (8 caracteres)
         codigo = secrets.token_hex(4).upper()
 
@@ -23,9 +21,9 @@ def create_grupo(db: Session, grupo_data, user_id: int):
             creado_por_id=user_id,
         )
 
+        # flush() asigna new_grupo.id sin cerrar la transacción
         db.add(new_grupo)
-        db.commit()
-        db.refresh(new_grupo)
+        db.flush()
 
         # Agregar al creador como admin en MiembroGrupo
         miembro_admin = MiembroGrupo(
@@ -40,13 +38,65 @@ def create_grupo(db: Session, grupo_data, user_id: int):
 
         return new_grupo
 
-    except HTTPException:
+    except IntegrityError as e:
         db.rollback()
-        raise
+        # El índice único parcial reemplaza la consulta previa de duplicados
+        if "uix_grupo_creador_nombre" in str(e.orig):
+            raise HTTPException(status_code=400, detail="Ya tienes un grupo con ese nombre")
+        raise HTTPException(status_code=500, detail=f"Error al crear grupo: {str(e)}")
     except SQLAlchemyError as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error al crear grupo: {str(e)}")
 
+# Accesos confirmados (grupo_id, user_id) -> True. Solo se cachean los positivos;
+# se invalidan al salir del grupo o al eliminarlo.
+_accesos_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+_accesos_lock = threading.Lock()
+
+def obtener_grupo_con_acceso(db: Session, grupo_id: int, user_id: int) -> Grupo:
+    """
+    Obtiene el grupo y valida que el usuario sea miembro activo o creador,
+    en una sola consulta (grupo + membresía por outer join).
+    """
+    fila = db.query(Grupo, MiembroGrupo.id).outerjoin(MiembroGrupo, and_(
+        MiembroGrupo.grupo_id == Grupo.id,
+        MiembroGrupo.usuario_id == user_id,
+        MiembroGrupo.activo == True
+    )).filter(
+        Grupo.id == grupo_id,
+        Grupo.is_deleted == False
+    ).first()
+
+    if not fila:
+        raise HTTPException(status_code=404, detail="Grupo no existe")
+
+    grupo, miembro_id = fila
+    if miembro_id is None and grupo.creado_por_id != user_id:
+        raise HTTPException(status_code=403, detail="No perteneces a este grupo")
+
+    with _accesos_lock:
+        _accesos_cache[(grupo_id, user_id)] = True
+    return grupo
+
+def verificar_acceso_grupo(db: Session, grupo_id: int, user_id: int):
+    """
+    Igual que obtener_grupo_con_acceso pero sin devolver el grupo:
+    si el acceso ya fue confirmado hace poco, no consulta la base de datos.
+    """
+    with _accesos_lock:
+        if _accesos_cache.get((grupo_id, user_id)):
+            return
+    obtener_grupo_con_acceso(db, grupo_id, user_id)
+
+def invalidar_acceso_grupo(grupo_id: int, user_id: int | None = None):
+    """Olvida los accesos cacheados de un usuario (o de todo el grupo si user_id es None)"""
+    with _accesos_lock:
+        if user_id is not None:
+            _accesos_cache.pop((grupo_id, user_id), None)
+            return
+        for clave in [c for c in _accesos_cache.keys() if c[0] == grupo_id]:
+            _accesos_cache.pop(clave, None)
+
 def salir_de_grupo(db: Session, grupo_id: int, user_id: int):
     grupo = db.query(Grupo).filter(
         Grupo.id == grupo_id,
@@ -74,6 +124,7 @@ def salir_de_grupo(db: Session, grupo_id: int, user_id: int):
     # 🔹 Solo esta parte cambia: no se borra, se desactiva
     miembro.activo = False
     db.commit()
+    invalidar_acceso_grupo(grupo_id, user_id)
 
     # 🔹 Mensaje más natural y limpio
     return {"message": "Has abandonado el grupo correctamente"}
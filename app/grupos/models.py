@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from ..database.database import Base
 
@@ -17,6 +17,16 @@ class Grupo(Base):
     
     is_deleted = Column(Boolean, default=False)  # Para "eliminación lógica"
 
+    # Un usuario no puede tener dos grupos activos con el mismo nombre
+    __table_args__ = (
+        Index(
+            'uix_grupo_creador_nombre',
+            'creado_por_id', 'nombre',
+            unique=True,
+            postgresql_where=text('is_deleted = false')
+        ),
+    )
+
 
 class MiembroGrupo(Base):
     __tablename__ = "miembros_grupo"
@@ -27,6 +37,12 @@ class MiembroGrupo(Base):
     activo = Column(Boolean, default=True)
     fecha_union = Column(DateTime, default=datetime.utcnow)
 
+    # Búsquedas por (usuario, activo, grupo) en listar, permisos, salir/unirse y no leídos;
+    # el join de listar se resuelve solo con el índice.
+    __table_args__ = (
+        Index('ix_miembro_usuario_activo_grupo', 'usuario_id', 'activo', 'grupo_id'),
+    )
+
     usuario = relationship("Usuario", backref="grupos_miembro")
     grupo = relationship("Grupo", back_populates="miembros")
 
@@ -40,6 +56,11 @@ class Mensaje(Base):
     fecha_creacion = Column(DateTime, default=datetime.utcnow)
     entregado_at = Column(DateTime, nullable=True)
 
+    # Historial de un grupo ordenado por fecha (ORDER BY ... DESC LIMIT n)
+    __table_args__ = (
+        Index('ix_mensajes_grupo_fecha', grupo_id, fecha_creacion.desc()),
+    )
+
     remitente = relationship("Usuario")
     grupo = relationship("Grupo")
     lecturas = relationship("LecturaMensaje", back_populates="mensaje", cascade="all, delete-orphan")
@@ -55,6 +76,10 @@ class LecturaMensaje(Base):
     # Evitar duplicados: un usuario solo puede leer un mensaje una vez
     __table_args__ = (
         UniqueConstraint('mensaje_id', 'usuario_id', name='uix_mensaje_usuario'),
+        # Join de no leídos por usuario
+        Index('ix_lecturas_usuario', 'usuario_id'),
+        # Conteo de lecturas por mensaje (leido_por_mi / total_lecturas) solo con el índice
+        Index('ix_lecturas_mensaje_usuario', 'mensaje_id', 'usuario_id', postgresql_include=['id']),
     )
     
     # Relaciones
@@ -1,23 +1,46 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.orm import Session, raiseload
 from .schemas import *
 from .models import *
-from .crud import create_grupo
+from .crud import create_grupo, salir_de_grupo, obtener_grupo_con_acceso, verificar_acceso_grupo, invalidar_acceso_grupo
 from ..database.database import get_db
-from ..usuarios.security import get_current_user
+from ..usuarios.security import get_current_user_perfil
 from datetime import datetime, timezone
+import orjson
 from ..usuarios.models import Usuario, DatosPersonales
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from .WebSocket.routers import router as ws_grupos_router
+from sqlalchemy import func, and_, or_, case, update, select, exists, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from .WebSocket.routers import manager, notify_mensaje_leido_sync
+import logging
 
-router = APIRouter(prefix="/grupos", tags=["Grupos"])
+logger = logging.getLogger(__name__)
+
+# orjson serializa las listas de mensajes/integrantes bastante más rápido que json
+router = APIRouter(prefix="/grupos", tags=["Grupos"], default_response_class=ORJSONResponse)
+
+
+def requiere_acceso_grupo(
+    grupo_id: int,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user_perfil)
+):
+    """Dependencia: el usuario debe ser miembro activo o creador del grupo (usa la caché de accesos)"""
+    verificar_acceso_grupo(db, grupo_id, current_user.id)
+
+def grupo_con_acceso(
+    grupo_id: int,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user_perfil)
+) -> Grupo:
+    """Dependencia: igual que requiere_acceso_grupo pero devuelve el grupo"""
+    return obtener_grupo_con_acceso(db, grupo_id, current_user.id)
 
 @router.post("/crear", response_model=GrupoOut)
 def create_new_grupo(
     grupo: GrupoCreate,
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user)
+    current_user=Depends(get_current_user_perfil)
 ):
     try:
         new_grupo = create_grupo(db, grupo, current_user.id)
@@ -27,32 +50,61 @@ def create_new_grupo(
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al crear grupo: {str(e)}")
 
-@router.get("/listar", response_model=list[GrupoOut])
+@router.get("/listar", response_model=list[GrupoConNoLeidos])
 def listar_grupos(
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user)
+    current_user=Depends(get_current_user_perfil)
 ):
-    grupos_creados = db.query(Grupo).filter(
-        Grupo.creado_por_id == current_user.id,
-        Grupo.is_deleted == False
-    )
-
-    grupos_miembro = db.query(Grupo).join(MiembroGrupo).filter(
-        MiembroGrupo.usuario_id == current_user.id,
-        MiembroGrupo.activo == True,
-        Grupo.is_deleted == False
-    )
-
-    grupos = grupos_creados.union(grupos_miembro).all()
-    return grupos
+    # Una sola consulta: grupos creados por el usuario o donde es miembro activo,
+    # con el conteo de mensajes no leídos de cada uno
+    # Solo columnas (select Core): sin identity map ni relaciones que cargar
+    filas = db.execute(
+        select(
+            Grupo.id,
+            Grupo.nombre,
+            Grupo.descripcion,
+            Grupo.codigo_invitacion,
+            Grupo.creado_por_id,
+            Grupo.fecha_creacion,
+            func.count(func.distinct(case((LecturaMensaje.id == None, Mensaje.id)))).label("mensajes_no_leidos")
+        )
+        .outerjoin(MiembroGrupo, and_(
+            MiembroGrupo.grupo_id == Grupo.id,
+            MiembroGrupo.usuario_id == current_user.id,
+            MiembroGrupo.activo == True
+        ))
+        .outerjoin(Mensaje, and_(
+            Mensaje.grupo_id == Grupo.id,
+            Mensaje.remitente_id != current_user.id
+        ))
+        .outerjoin(LecturaMensaje, and_(
+            LecturaMensaje.mensaje_id == Mensaje.id,
+            LecturaMensaje.usuario_id == current_user.id
+        ))
+        .where(
+            Grupo.is_deleted == False,
+            or_(
+                Grupo.creado_por_id == current_user.id,
+                MiembroGrupo.id.isnot(None)
+            )
+        )
+        .group_by(Grupo.id)
+    ).mappings().all()
+    # Diccionarios planos: response_model valida la lista una sola vez
+    return [dict(fila) for fila in filas]
 
 @router.post("/unirse/{codigo}", response_model=GrupoOut)
 def unirse_a_grupo(
     codigo: str,
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user)
+    current_user=Depends(get_current_user_perfil)
 ):
-    grupo = db.query(Grupo).filter_by(codigo_invitacion=codigo, is_deleted=False).first()
+    grupo = (
+        db.query(Grupo)
+        .filter_by(codigo_invitacion=codigo, is_deleted=False)
+        .options(raiseload('*'))  # GrupoOut solo usa columnas: nunca cargar relaciones
+        .first()
+    )
 
     if not grupo:
         raise HTTPException(status_code=404, detail="Código de invitación inválido o grupo inexistente")
@@ -71,9 +123,10 @@ def unirse_a_grupo(
         if not miembro_existente.activo:
             miembro_existente.activo = True
             miembro_existente.fecha_union = datetime.utcnow()  # Actualizar fecha de reingreso
+            # Serializar antes del commit: el grupo no cambia y así no se vuelve a leer
+            respuesta = GrupoOut.model_validate(grupo)
             db.commit()
-            db.refresh(grupo)
-            return grupo
+            return respuesta
         else:
             # Ya está activo
             raise HTTPException(status_code=400, detail="Ya perteneces a este grupo")
@@ -88,132 +141,182 @@ def unirse_a_grupo(
     )
 
     db.add(nuevo_miembro)
+    # Serializar antes del commit: el grupo no cambia y así no se vuelve a leer
+    respuesta = GrupoOut.model_validate(grupo)
     db.commit()
-    db.refresh(grupo)
 
-    return grupo
+    return respuesta
+
+# Tope de mensajes por página (la página completa se lee antes de responder)
+MENSAJES_LIMITE_MAXIMO = 200
 
-@router.get("/{grupo_id}/mensajes", response_model=list[MensajeOut])
+# La respuesta se envía en streaming (FastAPI no valida response_model en ese caso),
+# así que el esquema solo se documenta en OpenAPI
+@router.get(
+    "/{grupo_id}/mensajes",
+    responses={200: {"model": list[MensajeOut], "description": "Mensajes en orden cronológico"}},
+    dependencies=[Depends(requiere_acceso_grupo)]
+)
 def obtener_mensajes_grupo(
     grupo_id: int, 
-    limit: int = 50, 
-    db: Session = Depends(get_db), 
-    current_user = Depends(get_current_user)
+    limit: int = Query(50, ge=1, le=MENSAJES_LIMITE_MAXIMO), 
+    before_id: int | None = None,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user_perfil)
 ):
-    # Validar existencia del grupo
-    grupo = db.query(Grupo).filter(Grupo.id == grupo_id, Grupo.is_deleted == False).first()
-    if not grupo:
-        raise HTTPException(404, "Grupo no existe")
-    
-    # Validar membresía o permisos
-    miembro = db.query(MiembroGrupo).filter_by(
-        usuario_id=current_user.id, 
-        grupo_id=grupo_id, 
-        activo=True
-    ).first()
-    if not miembro and grupo.creado_por_id != current_user.id:
-        raise HTTPException(403, "No perteneces a este grupo")
-    
-    from sqlalchemy import case, func
+    """
+    Devuelve los últimos `limit` mensajes en orden cronológico.
+    Para cargar historial anterior, enviar `before_id` con el id del mensaje más antiguo recibido.
+    """
+    # Aplicar el LIMIT antes de agregar: solo se cuentan lecturas de los últimos mensajes.
+    # Paginación por keyset con cursor (fecha_creacion, id), el mismo orden del ORDER BY;
+    # la fecha del cursor se toma del propio mensaje before_id
+    recientes = select(Mensaje.id).where(Mensaje.grupo_id == grupo_id)
+    if before_id is not None:
+        fecha_cursor = (
+            select(Mensaje.fecha_creacion)
+            .where(Mensaje.id == before_id, Mensaje.grupo_id == grupo_id)
+            .scalar_subquery()
+        )
+        recientes = recientes.where(
+            tuple_(Mensaje.fecha_creacion, Mensaje.id) < tuple_(fecha_cursor, before_id)
+        )
+    recientes = (
+        recientes
+        .order_by(Mensaje.fecha_creacion.desc(), Mensaje.id.desc())
+        .limit(limit)
+        .subquery()
+    )
 
     # 🔥 Consulta mejorada: excluir al remitente del conteo de lecturas
-    mensajes = (
-        db.query(
-            Mensaje,
+    user_id = current_user.id
+
+    # La página completa (máximo MENSAJES_LIMITE_MAXIMO filas) se lee antes de empezar a
+    # responder: un error de BD devuelve 500 en vez de un JSON truncado con estado 200
+    filas = db.execute(
+        select(
+            Mensaje.id,
+            Mensaje.remitente_id,
+            Mensaje.grupo_id,
+            Mensaje.contenido,
+            Mensaje.tipo,
+            Mensaje.fecha_creacion,
+            Mensaje.entregado_at,
             func.sum(
-                case((LecturaMensaje.usuario_id == current_user.id, 1), else_=0)
+                case((LecturaMensaje.usuario_id == user_id, 1), else_=0)
             ).label("leido_por_mi"),
             func.count(
                 case((LecturaMensaje.usuario_id != Mensaje.remitente_id, LecturaMensaje.id), else_=None)
-            ).label("total_lecturas"),
-            DatosPersonales.nombre.label("nombre_remitente"),
-            DatosPersonales.apellido.label("apellido_remitente")
+            ).label("total_lecturas")
         )
-        .join(Usuario, Usuario.id == Mensaje.remitente_id)
-        .join(DatosPersonales, DatosPersonales.id == Usuario.datos_personales_id)
+        .join(recientes, recientes.c.id == Mensaje.id)
         .outerjoin(LecturaMensaje, Mensaje.id == LecturaMensaje.mensaje_id)
-        .filter(Mensaje.grupo_id == grupo_id)
-        .group_by(Mensaje.id, DatosPersonales.nombre, DatosPersonales.apellido)
-        .order_by(Mensaje.fecha_creacion.desc())
-        .limit(limit)
-        .all()
-    )
-    
-    resultado = []
-    for mensaje, leido_por_mi, total_lecturas, nombre, apellido in reversed(mensajes):
-        resultado.append(
-            MensajeOut(
-                id=mensaje.id,
-                remitente_id=mensaje.remitente_id,
-                remitente_nombre=f"{nombre} {apellido}",
-                grupo_id=mensaje.grupo_id,
-                contenido=mensaje.contenido,
-                tipo=mensaje.tipo,
-                fecha_creacion=mensaje.fecha_creacion,
-                entregado=bool(mensaje.entregado_at),  # 🆕 NUEVO
-                leido=bool(leido_por_mi > 0),
-                leido_por=total_lecturas or 0
-            )
+        .group_by(Mensaje.id)
+        .order_by(Mensaje.fecha_creacion.asc(), Mensaje.id.asc())
+    ).all()
+
+    # Nombres de todos los remitentes de la página en una sola consulta, antes del streaming
+    nombres: dict[int, str] = dict(db.execute(
+        select(
+            Usuario.id,
+            func.concat_ws(' ', DatosPersonales.nombre, DatosPersonales.apellido)
         )
+        .join(DatosPersonales, DatosPersonales.id == Usuario.datos_personales_id)
+        .where(Usuario.id.in_(
+            select(Mensaje.remitente_id).join(recientes, recientes.c.id == Mensaje.id)
+        ))
+    ).all())
 
-    return resultado
+    def generar_json():
+        # Solo se serializa en streaming: las filas ya están en memoria
+        yield b"["
+        primero = True
+        for fila in filas:
+            if not primero:
+                yield b","
+            primero = False
+            yield orjson.dumps({
+                "id": fila.id,
+                "remitente_id": fila.remitente_id,
+                "remitente_nombre": nombres.get(fila.remitente_id, ""),
+                "grupo_id": fila.grupo_id,
+                "contenido": fila.contenido,
+                "tipo": fila.tipo,
+                "fecha_creacion": fila.fecha_creacion,
+                "entregado": bool(fila.entregado_at),  # 🆕 NUEVO
+                "leido": bool(fila.leido_por_mi > 0),
+                "leido_por": fila.total_lecturas or 0
+            })
+        yield b"]"
+
+    # Se envía fila por fila sin armar el JSON completo en memoria
+    return StreamingResponse(generar_json(), media_type="application/json")
 
 @router.post("/{grupo_id}/mensajes/{mensaje_id}/marcar-leido")
 def marcar_mensaje_leido(
     grupo_id: int,
     mensaje_id: int,
     db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_user_perfil)
 ):
-    # Validar que el mensaje existe y pertenece al grupo
-    mensaje = db.query(Mensaje).filter(
-        Mensaje.id == mensaje_id,
-        Mensaje.grupo_id == grupo_id
+    # Una sola consulta: mensaje del grupo, permisos (miembro activo o creador) y lectura previa
+    mensaje = db.execute(
+        select(
+            Mensaje.remitente_id,
+            or_(
+                Grupo.creado_por_id == current_user.id,
+                MiembroGrupo.id.isnot(None)
+            ).label("tiene_acceso"),
+            exists().where(
+                LecturaMensaje.mensaje_id == Mensaje.id,
+                LecturaMensaje.usuario_id == current_user.id
+            ).label("ya_leido")
+        )
+        .join(Grupo, and_(Grupo.id == Mensaje.grupo_id, Grupo.is_deleted == False))
+        .outerjoin(MiembroGrupo, and_(
+            MiembroGrupo.grupo_id == Grupo.id,
+            MiembroGrupo.usuario_id == current_user.id,
+            MiembroGrupo.activo == True
+        ))
+        .where(Mensaje.id == mensaje_id, Mensaje.grupo_id == grupo_id)
     ).first()
     
     if not mensaje:
         raise HTTPException(404, "Mensaje no encontrado")
     
+    if not mensaje.tiene_acceso:
+        raise HTTPException(403, "No perteneces a este grupo")
+    
     # 🔥 No permitir que el remitente marque su propio mensaje como leído
     if mensaje.remitente_id == current_user.id:
         return {"message": "No puedes marcar tu propio mensaje como leído", "leido": False}
     
-    # Verificar permisos en el grupo
-    miembro = db.query(MiembroGrupo).filter_by(
-        usuario_id=current_user.id, 
-        grupo_id=grupo_id, 
-        activo=True
-    ).first()
-    
-    grupo = db.query(Grupo).filter_by(id=grupo_id).first()
-    if not miembro and grupo.creado_por_id != current_user.id:
-        raise HTTPException(403, "No perteneces a este grupo")
-    
-    # Verificar si ya fue leído
-    lectura_existente = db.query(LecturaMensaje).filter_by(
-        mensaje_id=mensaje_id,
-        usuario_id=current_user.id
-    ).first()
-    
-    if lectura_existente:
+    if mensaje.ya_leido:
         return {"message": "Mensaje ya marcado como leído", "leido": True}
     
-    # Crear registro de lectura
-    lectura = LecturaMensaje(
-        mensaje_id=mensaje_id,
-        usuario_id=current_user.id
+    # Crear registro de lectura y contar lecturas en un solo viaje (CTE):
+    # uix_mensaje_usuario hace el INSERT idempotente. La fila insertada no es visible
+    # para el SELECT de la misma sentencia, por eso se suma lo que devuelve el CTE.
+    insertada = (
+        pg_insert(LecturaMensaje)
+        .values(mensaje_id=mensaje_id, usuario_id=current_user.id, leido_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=['mensaje_id', 'usuario_id'])
+        .returning(LecturaMensaje.id)
+        .cte("insertada")
     )
-    db.add(lectura)
+    nuevas = select(func.count()).select_from(insertada).scalar_subquery()
+    previas = select(func.count(LecturaMensaje.id)).where(
+        LecturaMensaje.mensaje_id == mensaje_id,
+        LecturaMensaje.usuario_id != mensaje.remitente_id  # Excluir al remitente
+    ).scalar_subquery()
+    
+    nueva, total_lecturas = db.execute(select(nuevas, previas + nuevas)).one()
     db.commit()
     
-    # 🔥 NUEVO: Calcular total de lecturas (excluyendo al remitente)
-    total_lecturas = db.query(func.count(LecturaMensaje.id)).filter(
-        LecturaMensaje.mensaje_id == mensaje_id,
-        LecturaMensaje.usuario_id != mensaje.remitente_id
-    ).scalar() or 0
+    if nueva == 0:
+        return {"message": "Mensaje ya marcado como leído", "leido": True}
     
     # 🔥 NUEVO: Notificar por WebSocket usando la función helper
-    from .WebSocket.routers import notify_mensaje_leido_sync
     notify_mensaje_leido_sync(grupo_id, mensaje_id, total_lecturas)
     
     return {"message": "Mensaje marcado como leído", "leido": True}
@@ -222,53 +325,37 @@ def marcar_mensaje_leido(
 def integrantes_grupo(
     grupo_id: int,
     db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)  # ✅ Agregado paréntesis faltante
+    grupo: Grupo = Depends(grupo_con_acceso)
 ):
     """
     Obtiene la lista de integrantes de un grupo
     """
-    # Validar existencia del grupo
-    grupo = db.query(Grupo).filter(
-        Grupo.id == grupo_id, 
-        Grupo.is_deleted == False
-    ).first()
-    
-    if not grupo:
-        raise HTTPException(status_code=404, detail="Grupo no existe")
-    
-    # Validar membresía o permisos
-    miembro = db.query(MiembroGrupo).filter(
-        MiembroGrupo.usuario_id == current_user.id,
-        MiembroGrupo.grupo_id == grupo_id,
-        MiembroGrupo.activo == True
-    ).first()
-    
-    if not miembro and grupo.creado_por_id != current_user.id:
-        raise HTTPException(status_code=403, detail="No perteneces a este grupo")
-    
     # Obtener integrantes del grupo
-    integrantes = db.query(
-        Usuario.id,
-        DatosPersonales.nombre,
-        DatosPersonales.apellido,
-        MiembroGrupo.rol,
-        MiembroGrupo.activo,
-        MiembroGrupo.fecha_union
-    ).join(
-        DatosPersonales, 
-        DatosPersonales.id == Usuario.datos_personales_id
-    ).join(
-        MiembroGrupo, 
-        MiembroGrupo.usuario_id == Usuario.id
-    ).filter(
-        MiembroGrupo.grupo_id == grupo_id
+    integrantes = db.execute(
+        select(
+            Usuario.id,
+            DatosPersonales.nombre,
+            DatosPersonales.apellido,
+            func.concat_ws(' ', DatosPersonales.nombre, DatosPersonales.apellido).label("nombre_completo"),
+            MiembroGrupo.rol,
+            MiembroGrupo.activo,
+            MiembroGrupo.fecha_union
+        ).join(
+            DatosPersonales, 
+            DatosPersonales.id == Usuario.datos_personales_id
+        ).join(
+            MiembroGrupo, 
+            MiembroGrupo.usuario_id == Usuario.id
+        ).where(
+            MiembroGrupo.grupo_id == grupo_id
+        )
     ).all()
     
     resultado = []
-    for usuario_id, nombre, apellido, rol, activo, fecha_union in integrantes:
+    for usuario_id, nombre, apellido, nombre_completo, rol, activo, fecha_union in integrantes:
         resultado.append({
             "usuario_id": usuario_id,
-            "nombre_completo": f"{nombre} {apellido}",
+            "nombre_completo": nombre_completo,
             "nombre": nombre,
             "apellido": apellido,
             "rol": rol,
@@ -288,16 +375,15 @@ def integrantes_grupo(
 def salir_grupo(
     grupo_id: int,
     db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_user_perfil)
 ):
-    from .crud import salir_de_grupo
     return salir_de_grupo(db, grupo_id, current_user.id)
 
 @router.delete("/eliminar/{grupo_id}")
 def eliminar_grupo(
     grupo_id: int,
     db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_user_perfil)
 ):
     grupo = db.query(Grupo).filter(
         Grupo.id == grupo_id,
@@ -320,81 +406,55 @@ def eliminar_grupo(
     ).update({"activo": False})
 
     db.commit()
+    invalidar_acceso_grupo(grupo_id)
 
     return {"message": f"Grupo '{grupo.nombre}' eliminado correctamente"}
 
 
-@router.post("/{grupo_id}/mensajes/marcar-entregados")
+@router.post("/{grupo_id}/mensajes/marcar-entregados", dependencies=[Depends(requiere_acceso_grupo)])
 async def marcar_mensajes_entregados(  # 🔥 CAMBIO 1: Agregar async
     grupo_id: int,
     db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_user_perfil)
 ):
     """
     Marca TODOS los mensajes no entregados de un grupo como entregados
     Se llama cuando el usuario recibe FCM (incluso en segundo plano)
     """
-    # Validar que el usuario pertenece al grupo
-    grupo = db.query(Grupo).filter(
-        Grupo.id == grupo_id,
-        Grupo.is_deleted == False
-    ).first()
-    
-    if not grupo:
-        raise HTTPException(404, "Grupo no encontrado")
-    
-    miembro = db.query(MiembroGrupo).filter_by(
-        usuario_id=current_user.id,
-        grupo_id=grupo_id,
-        activo=True
-    ).first()
-    
-    if not miembro and grupo.creado_por_id != current_user.id:
-        raise HTTPException(403, "No perteneces a este grupo")
-    
-    # 🔥 MARCAR MENSAJES COMO ENTREGADOS
-    mensajes_no_entregados = db.query(Mensaje).filter(
-        Mensaje.grupo_id == grupo_id,
-        Mensaje.remitente_id != current_user.id,  # No marcar mis propios mensajes
-        Mensaje.entregado_at == None
-    ).all()
+    # 🔥 MARCAR MENSAJES COMO ENTREGADOS: un solo UPDATE que devuelve los ids
+    mensaje_ids = list(db.execute(
+        update(Mensaje)
+        .where(
+            Mensaje.grupo_id == grupo_id,
+            Mensaje.remitente_id != current_user.id,  # No marcar mis propios mensajes
+            Mensaje.entregado_at == None
+        )
+        .values(entregado_at=datetime.now(timezone.utc))
+        .returning(Mensaje.id)
+    ).scalars())
+    db.commit()
     
-    if not mensajes_no_entregados:
+    if not mensaje_ids:
         return {
             "message": "No hay mensajes pendientes de entrega",
             "mensajes_marcados": 0
         }
     
-    # Marcar como entregados
-    mensaje_ids = []
-    for mensaje in mensajes_no_entregados:
-        mensaje.entregado_at = datetime.now(timezone.utc)
-        mensaje_ids.append(mensaje.id)
+    logger.info("📬 ENDPOINT REST: %s mensajes marcados como entregados", len(mensaje_ids))
     
-    db.commit()
-    
-    print(f"📬 ════════════════════════════════════════")
-    print(f"📬 ENDPOINT REST: {len(mensaje_ids)} mensajes marcados como entregados")
-    print(f"📬 ════════════════════════════════════════")
-    
-    # 🔥 CAMBIO 2: NOTIFICAR POR WEBSOCKET CORRECTAMENTE
-    from .WebSocket.routers import manager
-    
-    for mensaje_id in mensaje_ids:
-        print(f"📤 Enviando notificación para mensaje {mensaje_id}")
-        
-        # 🔥 USAR await EN VEZ DE create_task
-        resultado = await manager.broadcast(grupo_id, {
-            "type": "mensaje_entregado",
-            "data": {
-                "mensaje_id": mensaje_id,
-                "entregado": True
-            }
-        })
-        
-        print(f"   {'✅' if resultado else '⚠️'} Broadcast resultado: {resultado}")
+    # 🔥 CAMBIO 2: NOTIFICAR POR WEBSOCKET EN UN SOLO FRAME
+    resultado = await manager.broadcast(grupo_id, {
+        "type": "mensajes_entregados",
+        "data": {
+            "mensaje_ids": mensaje_ids,
+            "entregado": True
+        }
+    })
     
-    print(f"✅ Notificaciones enviadas para {len(mensaje_ids)} mensajes")
+    if resultado:
+        logger.info("✅ Notificación de entrega enviada para %s mensajes", len(mensaje_ids))
+    else:
+        logger.warning("⚠️ Notificación de entrega no enviada para %s mensajes", len(mensaje_ids))
     
     return {
         "message": f"{len(mensaje_ids)} mensajes marcados como entregados",
@@ -1,5 +1,5 @@
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
 
 class GrupoCreate(BaseModel):
@@ -14,27 +14,12 @@ class GrupoOut(BaseModel):
     creado_por_id: int
     fecha_creacion: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class MensajeIn(BaseModel):
     contenido: str
     tipo: str = "texto"
 
-class MensajeOut(BaseModel):
-    id: int
-    remitente_id: int
-    remitente_nombre: str | None = None
-    grupo_id: int
-    contenido: str
-    tipo: str
-    fecha_creacion: datetime
-    leido: bool
-    leido_por: int
-    
-    class Config:
-        from_attributes = True
-
 class GrupoConNoLeidos(BaseModel):
     id: int
     nombre: str
@@ -44,8 +29,7 @@ class GrupoConNoLeidos(BaseModel):
     fecha_creacion: datetime
     mensajes_no_leidos: int = 0
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class MensajeOut(BaseModel):
     id: int
@@ -59,5 +43,4 @@ class MensajeOut(BaseModel):
     leido: bool
     leido_por: int
 
-    class Config:
-        from_attributes = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
@@ -1,20 +1,61 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, bindparam
+from sqlalchemy.orm import Session, joinedload
 from ..usuarios.models import Usuario
-from ..usuarios.security import verify_password, create_access_token
+from ..usuarios.security import verify_password_cached, create_access_token, password_needs_rehash, hash_password
+from cachetools import TTLCache
+import hashlib
 import logging
+import secrets
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Consulta de login construida una sola vez; su SQL compilado queda en la caché del engine
+USUARIO_ACTIVO_POR_CORREO = (
+    select(Usuario)
+    .options(joinedload(Usuario.rol))
+    .where(Usuario.usuario == bindparam("correo"), Usuario.activo == True)
+)
+
+# Credenciales incorrectas vistas hace poco: los reintentos idénticos se rechazan sin
+# tocar la BD ni el hash. La clave es un blake2b con pepper aleatorio por proceso,
+# así nunca se guarda la contraseña en claro.
+_PEPPER_FALLIDOS = secrets.token_bytes(32)
+_fallidos_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+_fallidos_lock = threading.Lock()
+
+def _clave_fallido(correo: str, contrasenia: str) -> bytes:
+    return hashlib.blake2b(
+        f"{correo}:{contrasenia}".encode(), digest_size=16, key=_PEPPER_FALLIDOS
+    ).digest()
+
+def es_login_fallido_reciente(correo: str, contrasenia: str) -> bool:
+    with _fallidos_lock:
+        return _clave_fallido(correo, contrasenia) in _fallidos_cache
+
+def registrar_login_fallido(correo: str, contrasenia: str):
+    with _fallidos_lock:
+        _fallidos_cache[_clave_fallido(correo, contrasenia)] = True
+
 def login_usuario(db: Session, correo: str, contrasenia: str):
-    usuario = db.query(Usuario).filter(Usuario.usuario == correo, Usuario.activo == True).first()
+    if es_login_fallido_reciente(correo, contrasenia):
+        return None
+
+    usuario = db.execute(USUARIO_ACTIVO_POR_CORREO, {"correo": correo}).scalar_one_or_none()
     if not usuario:
-        logger.info(f"❌ Usuario {correo} no encontrado o inactivo")
+        logger.info("❌ Usuario %s no encontrado o inactivo", correo)
         return None
     
-    if not verify_password(contrasenia, usuario.contrasenia):
-        logger.info(f"❌ Contraseña incorrecta para {correo}")
+    if not verify_password_cached(contrasenia, usuario.contrasenia):
+        registrar_login_fallido(correo, contrasenia)
+        logger.info("❌ Contraseña incorrecta para %s", correo)
         return None
     
+    # Migrar hashes bcrypt a argon2
+    if password_needs_rehash(usuario.contrasenia):
+        usuario.contrasenia = hash_password(contrasenia)
+        db.commit()
+    
     # Crear JWT
     token = create_access_token({"sub": usuario.usuario, "rol": usuario.rol.nombre})
     return token
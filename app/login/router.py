@@ -1,13 +1,19 @@
 from fastapi import APIRouter, Depends, Form, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from ..database.database import get_db
 from ..usuarios.security import *
 from ..usuarios.models import Usuario
 from datetime import datetime, timedelta
-from fastapi.responses import JSONResponse
-from ..usuarios.sesiones.crud import crear_sesion, obtener_sesion, inhabilitar_sesion
+import time
+import logging
+from fastapi.responses import ORJSONResponse
+from .crud import USUARIO_ACTIVO_POR_CORREO, es_login_fallido_reciente, registrar_login_fallido
+from ..usuarios.sesiones.crud import crear_sesion, obtener_sesion, inhabilitar_sesion, registrar_actividad
 
-router = APIRouter(prefix="/login", tags=["Login"])
+logger = logging.getLogger(__name__)
+
+# Solo las respuestas de login usan orjson (tokens y strings: misma salida que json)
+router = APIRouter(prefix="/login", tags=["Login"], default_response_class=ORJSONResponse)
 
 # 🔹 Login
 @router.post("/")
@@ -19,22 +25,43 @@ def login(
     ip: str = Form(None),
     db: Session = Depends(get_db)
 ):
-    usuario = db.query(Usuario).filter(Usuario.usuario==correo, Usuario.activo==True).first()
-    if not usuario or not verify_password(contrasenia, usuario.contrasenia):
+    # 🛡️ Mismas credenciales incorrectas hace menos de 60 s: rechazar sin BD ni hash
+    if es_login_fallido_reciente(correo, contrasenia):
+        raise HTTPException(
+        status_code=401,
+        detail="Usuario o contraseña incorrectos"
+        )
+
+    usuario = db.execute(USUARIO_ACTIVO_POR_CORREO, {"correo": correo}).scalar_one_or_none()
+    if not usuario:
+        raise HTTPException(
+        status_code=401,
+        detail="Usuario o contraseña incorrectos"
+        )
+    if not verify_password_cached(contrasenia, usuario.contrasenia):
+        registrar_login_fallido(correo, contrasenia)
         raise HTTPException(
         status_code=401,
         detail="Usuario o contraseña incorrectos"
         )
 
+    # Migrar hashes bcrypt a argon2 (se guarda con el commit de crear_sesion)
+    if password_needs_rehash(usuario.contrasenia):
+        usuario.contrasenia = hash_password(contrasenia)
+
+    # Leer los atributos ORM una sola vez para ambos tokens
+    usuario_id = usuario.id
+    rol_nombre = usuario.rol.nombre
+
     access_token = create_access_token(
-        {"sub": correo, "id_usuario": usuario.id, "rol": usuario.rol.nombre}
+        {"sub": correo, "id_usuario": usuario_id, "rol": rol_nombre}
     )
-    refresh_token = create_refresh_token()
     expiracion = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    refresh_token = create_refresh_token()
 
-    crear_sesion(db, usuario.id, refresh_token, expiracion, dispositivo, version_app, ip)
+    crear_sesion(db, usuario_id, refresh_token, expiracion, dispositivo, version_app, ip)
 
-    return JSONResponse({
+    return ORJSONResponse({
         "access_token": access_token,
         "refresh_token": refresh_token,
         "token_type": "bearer"
@@ -43,36 +70,42 @@ def login(
 # 🔹 Refresh token
 @router.post("/refresh")
 def refresh_token(refresh_token: str = Form(...), db: Session = Depends(get_db)):
+    # La sesión en BD decide siempre (logout en cualquier worker, usuario desactivado)
     sesion = obtener_sesion(db, refresh_token)
-    if not sesion:
+    if not sesion or not sesion.usuario.activo:
         raise HTTPException(status_code=401, detail="REFRESH_INVALIDO")
+
+    ahora = datetime.utcnow()  # Una sola lectura del reloj para toda la rotación
     
     # Verificar que el refresh token no haya expirado
-    if sesion.expiracion < datetime.utcnow():
+    if sesion.expiracion < ahora:
         inhabilitar_sesion(db, refresh_token)
         raise HTTPException(status_code=401, detail="REFRESH_EXPIRADO")
 
     # Renovar access token
+    usuario = sesion.usuario
+    correo, usuario_id, rol_nombre = usuario.usuario, usuario.id, usuario.rol.nombre
     nuevo_access = create_access_token(
-        {"sub": sesion.usuario.usuario, "id_usuario": sesion.usuario.id, "rol": sesion.usuario.rol.nombre}
+        {"sub": correo, "id_usuario": usuario_id, "rol": rol_nombre}
     )
 
     # 🆕 CLAVE: Renovar refresh token si está cerca de expirar
-    tiempo_restante = sesion.expiracion - datetime.utcnow()
+    tiempo_restante = sesion.expiracion - ahora
     
     # Si le quedan menos de 7 días, renovar el refresh token
     if tiempo_restante.days < 7:
+        nueva_expiracion = ahora + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
         nuevo_refresh = create_refresh_token()
-        nueva_expiracion = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
         
         sesion.refresh_token = nuevo_refresh
         sesion.expiracion = nueva_expiracion
+        sesion.ultima_actividad = ahora
+        db.commit()  # Solo la rotación escribe en línea
         
-        print(f"🔄 Refresh token renovado. Nueva expiración: {nueva_expiracion}")
+        logger.debug("🔄 Refresh token renovado. Nueva expiración: %s", nueva_expiracion)
     else:
         nuevo_refresh = refresh_token  # Mantener el mismo
-
-    db.commit()
+        registrar_actividad(refresh_token)
 
     return {
         "access_token": nuevo_access,
@@ -95,10 +128,13 @@ def decodificar(
     db: Session = Depends(get_db)
 ):
     correo = payload.get("sub")
-    usuario = db.query(Usuario).filter(Usuario.usuario==correo, Usuario.activo==True).first()
+    usuario = db.query(Usuario).options(
+        joinedload(Usuario.rol),
+        joinedload(Usuario.datos_personales)
+    ).filter(Usuario.usuario==correo, Usuario.activo==True).first()
     if not usuario:
         raise HTTPException(status_code=404, detail="USUARIO_NO_ENCONTRADO")
-    return JSONResponse({
+    return ORJSONResponse({
         "id": usuario.id,
         "nombre": usuario.datos_personales.nombre,
         "apellido": usuario.datos_personales.apellido,
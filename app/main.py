@@ -9,9 +9,12 @@ from .ubicaciones.ubicaciones_historial.models import *
 from .services.models import *
 from .ubicaciones.ubicaciones_historial.rutas.models import *
 from .database.seed import create_default_roles_and_admin
+from .usuarios.sesiones.crud import vaciar_actividad, vaciar_actividad_periodicamente
 from .ubicaciones.ubicaciones_historial.seed import create_default_estados_ubicacion
 from .grupos.models import *
 from .seguridad.models import *
+from .grupos.WebSocket.ws_manager import registrar_loop_principal
+import asyncio
 import logging
 
 # Configurar logging
@@ -33,6 +36,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # TrustedHost para WebSockets
@@ -72,9 +76,19 @@ async def health_check():
     return health_status
 
 
+def ejecutar_con_sesion(fn):
+    db = SessionLocal()
+    try:
+        fn(db)
+    finally:
+        db.close()
+
 @app.on_event("startup")
 async def startup_event():
     logger.info(f"🚀 Iniciando {settings.app_name}")
+    # Los endpoints síncronos programan sus broadcasts de WebSocket en este loop
+    registrar_loop_principal()
+    app.state.rutas_por_modulo = construir_rutas_por_modulo(app.routes)
     
     if test_connection():
         logger.info("✅ Base de datos conectada correctamente")
@@ -84,18 +98,21 @@ async def startup_event():
         logger.info("✅ Tablas creadas exitosamente")
         
         # PASO 2: Crear datos semilla
-        db = SessionLocal()
-        try:
-            create_default_roles_and_admin(db)
-            create_default_estados_ubicacion(db)
-            
-            from app.ubicaciones.ubicaciones_historial.rutas.models import Transporte
-            from app.ubicaciones.ubicaciones_historial.rutas.seed import seed_transportes
-            seed_transportes(db)
-            logger.info("✅ Transportes creados exitosamente")
-            
-        finally:
-            db.close()
+        # Cada semilla es independiente: corren en paralelo, cada una con su propia sesión
+        from app.ubicaciones.ubicaciones_historial.rutas.seed import seed_transportes
+        await asyncio.gather(*[
+            asyncio.to_thread(ejecutar_con_sesion, fn)
+            for fn in (
+                create_default_roles_and_admin,
+                create_default_estados_ubicacion,
+                seed_transportes,
+            )
+        ])
+        logger.info("✅ Transportes creados exitosamente")
+        
+        # PASO 3: Guardar en lote la actividad de sesiones (refresh)
+        # Se guarda la referencia para cancelarla al apagar (y para que no la recolecte el GC)
+        app.state.tarea_actividad = asyncio.create_task(vaciar_actividad_periodicamente())
     else:
         logger.error("❌ No se pudo conectar a la base de datos")
 
@@ -106,11 +123,20 @@ async def shutdown_event():
     Se ejecuta al cerrar la aplicación.
     """
     logger.info("🛑 Cerrando la aplicación")
+    
+    tarea = getattr(app.state, "tarea_actividad", None)
+    if tarea:
+        tarea.cancel()
+        await asyncio.gather(tarea, return_exceptions=True)
+        # Guardar las marcas de actividad que quedaron pendientes
+        try:
+            await asyncio.to_thread(vaciar_actividad)
+        except Exception as e:
+            logger.error(f"❌ Error guardando ultima_actividad al cerrar: {e}")
 
-@app.get("/")
-async def root():
+def construir_rutas_por_modulo(routes) -> dict:
     rutas_por_modulo = {}
-    for route in app.routes:
+    for route in routes:
         if hasattr(route, "path") and route.path not in ["/", "/docs", "/redoc", "/openapi.json", "/docs/oauth2-redirect"]:
             prefijo = route.path.strip("/").split("/")[0]
             if prefijo not in rutas_por_modulo:
@@ -124,6 +150,11 @@ async def root():
             })
     return rutas_por_modulo
 
+@app.get("/")
+async def root():
+    # Las rutas no cambian después del arranque: se calculan en startup_event
+    return app.state.rutas_por_modulo
+
 
 # Incluir routers
 from .usuarios.router import router as usuarios_router
@@ -1,52 +1,58 @@
+from sqlalchemy import select, update, bindparam
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from .models import Reminder
-from .schemas import ReminderCreate
+from .schemas import ReminderCreate, ReminderOut
 from fastapi import HTTPException
-import locale
+from pydantic import TypeAdapter
+from cachetools import TTLCache
+import logging
+import threading
 
-try:
-    locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
-except locale.Error:
-    try:
-        locale.setlocale(locale.LC_TIME, 'es_ES')
-    except locale.Error:
-        pass
+logger = logging.getLogger(__name__)
+
+# Consultas construidas una sola vez; su SQL compilado queda en la caché del engine
+_LIST_STMT = select(Reminder).where(
+    Reminder.user_id == bindparam("uid"),
+    Reminder.is_deleted == False
+)
+_FETCH_BY_ID_STMT = select(Reminder).where(
+    Reminder.id == bindparam("rid"),
+    Reminder.user_id == bindparam("uid"),
+    Reminder.is_deleted == False
+)
 
 def create_reminder(db: Session, reminder_data: ReminderCreate, user_id: int):
     try:
-        # Verificar si ya existe
-        existing = db.query(Reminder).filter_by(
-            user_id=user_id, 
-            title=reminder_data.title
+        # Solo los campos enviados; los omitidos toman el default de la columna
+        reminder_dict = reminder_data.model_dump(exclude_unset=True, exclude_none=True)
+
+        # Un solo INSERT Core (sin unit of work del ORM): si el título ya existe
+        # (ix_reminders_user_title) no devuelve fila. El índice está garantizado:
+        # create_indexes() detiene el arranque si no puede crear un índice único
+        new_reminder = db.execute(
+            pg_insert(Reminder.__table__)
+            .values(**reminder_dict, user_id=user_id)
+            .on_conflict_do_nothing(
+                index_elements=["user_id", "title"],
+                index_where=Reminder.__table__.c.is_deleted == False
+            )
+            .returning(*Reminder.__table__.c)
         ).first()
-        
-        if existing:
+
+        if new_reminder is None:
             raise HTTPException(
                 status_code=400, 
                 detail="Ya existe un recordatorio con ese título"
             )
 
-        reminder_dict = reminder_data.dict()
-        
-        print(f"🔍 DEBUG CREATE REMINDER:")
-        print(f"   days tipo: {type(reminder_dict.get('days'))}")
-        print(f"   days valor: {reminder_dict.get('days')}")
-
-        new_reminder = Reminder(
-            **reminder_dict,
-            user_id=user_id
-        )
-
-        db.add(new_reminder)
+        # RETURNING ya trajo la fila: se serializa directamente desde el Row
+        respuesta = ReminderOut.model_validate(new_reminder)
         db.commit()
-        db.refresh(new_reminder)
-        
-        print(f"✅ Recordatorio guardado en BD:")
-        print(f"   ID: {new_reminder.id}")
-        print(f"   days en BD: {new_reminder.days}")
-        
-        return new_reminder
+        invalidar_reminders(user_id)
+
+        return respuesta
 
     except HTTPException:
         db.rollback()
@@ -60,23 +66,52 @@ def create_reminder(db: Session, reminder_data: ReminderCreate, user_id: int):
     
 def list_reminders(db: Session, user_id: int):
     try:
-        reminders = db.query(Reminder).filter_by(
-            user_id=user_id,
-            is_deleted=False
-        ).all()
+        reminders = db.execute(_LIST_STMT, {"uid": user_id}).scalars().all()
         return reminders
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener recordatorios: {str(e)}")
+
+# Listados ya serializados a JSON por usuario. Toda escritura invalida la entrada del
+# usuario; la generación evita guardar un listado leído antes de una escritura concurrente.
+_listas_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+_listas_lock = threading.Lock()
+_listas_generacion = 0
+_LISTA_ADAPTER = TypeAdapter(list[ReminderOut])
+
+def list_reminders_json(db: Session, user_id: int) -> bytes:
+    with _listas_lock:
+        contenido = _listas_cache.get(user_id)
+        generacion = _listas_generacion
+    if contenido is not None:
+        return contenido
+
+    reminders = list_reminders(db, user_id)
+    contenido = _LISTA_ADAPTER.dump_json(
+        _LISTA_ADAPTER.validate_python(reminders, from_attributes=True)
+    )
+    with _listas_lock:
+        if generacion == _listas_generacion:
+            _listas_cache[user_id] = contenido
+    return contenido
+
+def invalidar_reminders(user_id: int):
+    global _listas_generacion
+    with _listas_lock:
+        _listas_generacion += 1
+        _listas_cache.pop(user_id, None)
     
 def update_reminder(db: Session, reminder_id: int, user_id: int, reminder_data: dict):
     try:
-        # 🔵 LOG AGREGADO
-        print(f"🔵 Buscando reminder_id={reminder_id} para user_id={user_id}")
-        
-        reminder = db.query(Reminder).filter_by(
-            id=reminder_id, 
-            user_id=user_id, 
-            is_deleted=False
+        # Actualizar solo los campos proporcionados (el router ya excluye los no enviados y los None)
+        cambios = reminder_data
+
+        # UPDATE ... RETURNING: la fila actualizada vuelve en el mismo viaje
+        # (edit_reminder ya resolvió el caso sin cambios)
+        reminder = db.scalars(
+            update(Reminder)
+            .where(Reminder.id == reminder_id, Reminder.user_id == user_id, Reminder.is_deleted == False)
+            .values(**cambios)
+            .returning(Reminder)
         ).first()
         
         if not reminder:
@@ -85,36 +120,30 @@ def update_reminder(db: Session, reminder_id: int, user_id: int, reminder_data:
                 detail="Recordatorio no encontrado"
             )
         
-        # 🔵 LOG AGREGADO
-        print(f"🔵 reminder_type ANTES del update: {reminder.reminder_type}")
-        
-        # Actualizar solo los campos proporcionados
-        for key, value in reminder_data.items():
-            if value is not None:
-                # 🔵 LOG AGREGADO
-                print(f"🔵 Actualizando {key} = {value}")
-                setattr(reminder, key, value)
-        
-        # 🔵 LOG AGREGADO
-        print(f"🔵 reminder_type DESPUÉS del setattr: {reminder.reminder_type}")
-        print(f"🔵 Ejecutando db.commit()...")
-        
+        respuesta = ReminderOut.model_validate(reminder)
         db.commit()
-        db.refresh(reminder)
-        
-        # 🔵 LOG AGREGADO
-        print(f"🔵 reminder_type DESPUÉS del commit: {reminder.reminder_type}")
-        print(f"✅ Reminder actualizado exitosamente")
-        
-        return reminder
+        invalidar_reminders(user_id)
+
+        return respuesta
         
     except HTTPException:
         db.rollback()
-        print(f"❌ HTTPException - Rollback ejecutado")
         raise
+    except IntegrityError as e:
+        db.rollback()
+        # Cambiar el título a uno que el usuario ya usa (ix_reminders_user_title)
+        if "ix_reminders_user_title" in str(e.orig):
+            raise HTTPException(
+                status_code=400, 
+                detail="Ya existe un recordatorio con ese título"
+            )
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Error al actualizar recordatorio: {str(e)}"
+        )
     except SQLAlchemyError as e:
         db.rollback()
-        print(f"❌ SQLAlchemyError - Rollback ejecutado: {str(e)}")
+        logger.error("❌ SQLAlchemyError - Rollback ejecutado: %s", e)
         raise HTTPException(
             status_code=500, 
             detail=f"Error al actualizar recordatorio: {str(e)}"
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Date, Time
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Date, Time, Index, text
 from sqlalchemy.orm import relationship
 from enum import Enum as PyEnum
 from ..database.database import Base
@@ -16,6 +16,20 @@ class TriggerType(PyEnum):
 class Reminder(Base):
     __tablename__ = "reminders"
 
+    __table_args__ = (
+        # Listado de recordatorios vigentes de un usuario
+        Index('ix_reminders_user_active', 'user_id', 'is_deleted'),
+        # Un usuario no puede repetir el título entre sus recordatorios vigentes.
+        # create_reminder lo usa en ON CONFLICT: si create_indexes() no logra crearlo, la app no arranca
+        # (preparar_indices_unicos() resuelve antes los duplicados existentes)
+        Index(
+            'ix_reminders_user_title',
+            'user_id', 'title',
+            unique=True,
+            postgresql_where=text('is_deleted = false')
+        ),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(100), nullable=False)
     description = Column(String, nullable=True)
@@ -40,7 +54,8 @@ class Reminder(Base):
 
     # Relación con usuario
     user_id = Column(Integer, ForeignKey("usuarios.id"), nullable=False)
-    user = relationship("Usuario", back_populates="reminders")
+    # Ningún endpoint serializa el usuario: un acceso accidental falla en vez de hacer N+1
+    user = relationship("Usuario", back_populates="reminders", lazy="raise")
 
     # NUEVOS CAMPOS
     is_active = Column(Boolean, default=True)
@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from .schemas import ReminderCreate, ReminderOut, ReminderUpdate
 from .crud import *
+from .crud import _FETCH_BY_ID_STMT
 from ..database.database import get_db
-from ..usuarios.security import get_current_user
+from ..usuarios.security import get_current_user_perfil
 
 router = APIRouter(prefix="/reminders", tags=["Reminders"])
 
@@ -11,7 +13,7 @@ router = APIRouter(prefix="/reminders", tags=["Reminders"])
 def create_new_reminder(
     reminder: ReminderCreate,
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user)
+    current_user=Depends(get_current_user_perfil)
 ):
     try:
         new_reminder = create_reminder(db, reminder, current_user.id)
@@ -22,29 +24,41 @@ def create_new_reminder(
 @router.get("/listar", response_model=list[ReminderOut])
 def get_user_reminders(
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user)
+    current_user=Depends(get_current_user_perfil)
 ):
-    return list_reminders(db, current_user.id)
+    # JSON ya serializado (caché por usuario de 30 s, invalidada en cada escritura)
+    return Response(content=list_reminders_json(db, current_user.id), media_type="application/json")
 
 @router.patch("/{reminder_id}/toggle")
-def toggle_reminder(reminder_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user)):
-    reminder = db.query(Reminder).filter_by(id=reminder_id, user_id=current_user.id, is_deleted=False).first()
+def toggle_reminder(reminder_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user_perfil)):
+    # Un solo UPDATE ... RETURNING: invierte is_active y devuelve la fila
+    reminder = db.scalars(
+        update(Reminder)
+        .where(Reminder.id == reminder_id, Reminder.user_id == current_user.id, Reminder.is_deleted == False)
+        .values(is_active=~Reminder.is_active)
+        .returning(Reminder)
+    ).first()
     if not reminder:
         raise HTTPException(status_code=404, detail="Recordatorio no encontrado")
     
-    reminder.is_active = not reminder.is_active
+    respuesta = ReminderOut.model_validate(reminder)
     db.commit()
-    db.refresh(reminder)
-    return reminder
+    invalidar_reminders(current_user.id)
+    return respuesta
 
 @router.delete("/{reminder_id}/delete")
-def delete_reminder(reminder_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user)):
-    reminder = db.query(Reminder).filter_by(id=reminder_id, user_id=current_user.id, is_deleted=False).first()
-    if not reminder:
+def delete_reminder(reminder_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user_perfil)):
+    eliminado = db.execute(
+        update(Reminder)
+        .where(Reminder.id == reminder_id, Reminder.user_id == current_user.id, Reminder.is_deleted == False)
+        .values(is_deleted=True)
+        .returning(Reminder.id)
+    ).first()
+    if not eliminado:
         raise HTTPException(status_code=404, detail="Recordatorio no encontrado")
     
-    reminder.is_deleted = True
     db.commit()
+    invalidar_reminders(current_user.id)
     return {"detail": "Recordatorio eliminado"}
 
 @router.put("/{reminder_id}/editar", response_model=ReminderOut)
@@ -52,15 +66,17 @@ def edit_reminder(
     reminder_id: int,
     reminder_update: ReminderUpdate,
     db: Session = Depends(get_db),
-    current_user=Depends(get_current_user)
+    current_user=Depends(get_current_user_perfil)
 ):
     # Convertir a dict y filtrar valores None
-    update_data = reminder_update.dict(exclude_unset=True)
+    update_data = reminder_update.model_dump(exclude_unset=True, exclude_none=True)
     
-    # 🔵 LOGS AGREGADOS
-    print(f"🔵 REQUEST BODY RECIBIDO: {update_data}")
-    print(f"🔵 reminder_type = {update_data.get('reminder_type')}")
-    print(f"🔵 Editando reminder_id = {reminder_id}")
+    # Sin cambios: devolver la fila actual sin UPDATE ni commit
+    if not update_data:
+        reminder = db.execute(_FETCH_BY_ID_STMT, {"rid": reminder_id, "uid": current_user.id}).scalars().first()
+        if not reminder:
+            raise HTTPException(status_code=404, detail="Recordatorio no encontrado")
+        return reminder
     
     updated_reminder = update_reminder(db, reminder_id, current_user.id, update_data)
     return updated_reminder
\ No newline at end of file
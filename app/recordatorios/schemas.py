@@ -1,4 +1,4 @@
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, ConfigDict, field_validator
 from typing import Optional, List, Union
 from datetime import time as datetime_time
 from enum import Enum
@@ -19,6 +19,18 @@ class SoundType(str, Enum):
     ALERT = "alert"
     CHIME = "chime"
 
+def _normalizar_days(v):
+    """Convertir days a string si viene como lista"""
+    if v is None:
+        return None
+    if isinstance(v, list):
+        # Unir la lista con comas
+        return ','.join(v)
+    if isinstance(v, str):
+        # Ya es string, devolverlo tal cual
+        return v
+    raise ValueError("days debe ser una lista o un string")
+
 class ReminderBase(BaseModel):
     title: str
     description: Optional[str] = None
@@ -40,16 +52,7 @@ class ReminderBase(BaseModel):
     @field_validator('days')
     @classmethod
     def normalize_days(cls, v):
-        """Convertir days a string si viene como lista"""
-        if v is None:
-            return None
-        if isinstance(v, list):
-            # Unir la lista con comas
-            return ','.join(v)
-        if isinstance(v, str):
-            # Ya es string, devolverlo tal cual
-            return v
-        raise ValueError("days debe ser una lista o un string")
+        return _normalizar_days(v)
 
 class ReminderCreate(ReminderBase):
     pass
@@ -60,28 +63,10 @@ class ReminderOut(ReminderBase):
     is_active: bool = True
     is_deleted: bool = False
 
-    @field_validator('days', mode='before')
-    @classmethod
-    def convert_days_to_string(cls, v):
-        """
-        ✅ CORRECCIÓN: Mantener days como STRING en la respuesta
-        El frontend se encarga de convertirlo a lista con su DaysTypeAdapter
-        """
-        if v is None:
-            return None
-        
-        # Si ya es string, devolverlo tal cual
-        if isinstance(v, str):
-            return v
-        
-        # Si por alguna razón es una lista, convertirla a string
-        if isinstance(v, list):
-            return ','.join(v)
-        
-        return v
+    # days sale como STRING tal cual se guarda; el frontend lo convierte a lista con su
+    # DaysTypeAdapter. El normalize_days heredado ya cubre el caso de una lista.
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class ReminderUpdate(BaseModel):
     title: Optional[str] = None
@@ -102,11 +87,4 @@ class ReminderUpdate(BaseModel):
     @field_validator('days')
     @classmethod
     def normalize_days(cls, v):
-        """Convertir days a string si viene como lista"""
-        if v is None:
-            return None
-        if isinstance(v, list):
-            return ','.join(v)
-        if isinstance(v, str):
-            return v
-        raise ValueError("days debe ser una lista o un string")
\ No newline at end of file
+        return _normalizar_days(v)
\ No newline at end of file
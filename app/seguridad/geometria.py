@@ -1,5 +1,5 @@
 import math
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 def crear_poligono_circular(lat: float, lon: float, radio_metros: int, num_puntos: int = 32) -> List[Dict]:
     """
@@ -59,6 +59,32 @@ def calcular_distancia_haversine(lat1: float, lon1: float, lat2: float, lon2: fl
     
     return R * c
 
+def distancia_desde(lat0: float, lon0: float):
+    """
+    Prepara Haversine para muchas distancias desde un mismo origen: el coseno y los
+    radianes del origen se calculan una sola vez
+    
+    Args:
+        lat0, lon0: Coordenadas del origen
+    
+    Returns:
+        Función distancia(lat, lon) -> metros (mismo resultado que calcular_distancia_haversine)
+    """
+    R = 6371000
+    radians, sin, cos, sqrt, atan2 = math.radians, math.sin, math.cos, math.sqrt, math.atan2
+    
+    phi1 = radians(lat0)
+    cos_phi1 = cos(phi1)
+    
+    def distancia(lat: float, lon: float) -> float:
+        delta_phi = radians(lat - lat0)
+        delta_lambda = radians(lon - lon0)
+        a = (sin(delta_phi / 2) ** 2 +
+             cos_phi1 * cos(radians(lat)) * sin(delta_lambda / 2) ** 2)
+        return R * 2 * atan2(sqrt(a), sqrt(1 - a))
+    
+    return distancia
+
 def validar_coordenadas(lat: float, lon: float) -> bool:
     """
     Valida que las coordenadas sean válidas
@@ -93,4 +119,86 @@ def calcular_bounding_box(puntos: List[Dict]) -> Dict:
         'max_lat': max(lats),
         'min_lon': min(lons),
         'max_lon': max(lons)
-    }
\ No newline at end of file
+    }
+
+def calcular_caja_radio(lat: float, lon: float, radio_metros: float) -> Dict:
+    """
+    Calcula una caja que contiene todo el círculo de radio_metros alrededor de un punto
+    (con 1% de margen, para que el filtro nunca descarte puntos que Haversine sí acepta)
+    
+    Args:
+        lat, lon: Centro del círculo
+        radio_metros: Radio en metros
+    
+    Returns:
+        {'min_lat': float, 'max_lat': float, 'min_lon': float, 'max_lon': float}
+    """
+    R = 6371000  # Mismo radio terrestre que calcular_distancia_haversine
+    
+    margen = radio_metros * 1.01
+    dlat = math.degrees(margen / R)
+    # El coseno en el borde más cercano al polo da la caja más ancha (la segura)
+    cos_lat = math.cos(math.radians(min(89.9, abs(lat) + dlat)))
+    dlon = math.degrees(margen / (R * cos_lat))
+    
+    return {
+        'min_lat': lat - dlat,
+        'max_lat': lat + dlat,
+        'min_lon': lon - dlon,
+        'max_lon': lon + dlon
+    }
+
+
+def cajas_se_intersectan(a: Dict, b: Dict) -> bool:
+    """
+    Indica si dos bounding boxes se tocan (4 comparaciones, sin trigonometría)
+    
+    Args:
+        a, b: {'min_lat', 'max_lat', 'min_lon', 'max_lon'}
+    
+    Returns:
+        True si se solapan
+    """
+    return not (
+        a['max_lat'] < b['min_lat'] or a['min_lat'] > b['max_lat'] or
+        a['max_lon'] < b['min_lon'] or a['min_lon'] > b['max_lon']
+    )
+
+
+class IndiceCuadricula:
+    """
+    Índice espacial simple por celdas de tamano_celda grados (~1.1 km con 0.01).
+    Cada elemento se registra en todas las celdas que cubre su bounding box; una
+    consulta con los puntos de una ruta devuelve solo los elementos de esas celdas.
+    """
+    
+    def __init__(self, tamano_celda: float = 0.01):
+        self.tamano_celda = tamano_celda
+        self._elementos = []
+        self._celdas: Dict[Tuple[int, int], List[int]] = {}
+    
+    def _celda(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.tamano_celda), math.floor(lon / self.tamano_celda))
+    
+    def agregar(self, elemento, caja: Dict):
+        """Registra un elemento con su bounding box"""
+        indice = len(self._elementos)
+        self._elementos.append(elemento)
+        min_i, min_j = self._celda(caja['min_lat'], caja['min_lon'])
+        max_i, max_j = self._celda(caja['max_lat'], caja['max_lon'])
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                self._celdas.setdefault((i, j), []).append(indice)
+    
+    def candidatos(self, puntos: List[Dict]) -> List:
+        """
+        Elementos cuya caja comparte celda con algún punto, en el orden en que se agregaron
+        """
+        if not self._celdas:
+            return []
+        
+        celdas_ruta = {self._celda(p['lat'], p['lon']) for p in puntos}
+        indices = set()
+        for celda in celdas_ruta:
+            indices.update(self._celdas.get(celda, ()))
+        return [self._elementos[i] for i in sorted(indices)]
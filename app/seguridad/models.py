@@ -1,7 +1,9 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, JSON, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, Numeric, Boolean, DateTime, JSON, ForeignKey, Index, text, literal_column, func, cast
+from sqlalchemy.orm import relationship, query_expression
 from datetime import datetime
+import math
 from ..database.database import Base
+from .geometria import calcular_caja_radio
 
 class ZonaPeligrosaUsuario(Base):
     """
@@ -10,6 +12,23 @@ class ZonaPeligrosaUsuario(Base):
     """
     __tablename__ = "zonas_peligrosas_usuario"
     
+    # Centro de la zona (primer punto del polígono) indexado para filtrar por cercanía en SQL
+    __table_args__ = (
+        Index(
+            'ix_zonas_centro',
+            text("((poligono -> 0 ->> 'lat')::float8)"),
+            text("((poligono -> 0 ->> 'lon')::float8)"),
+        ),
+        # Listado paginado de /mis-zonas (keyset por fecha_creacion, id) de las zonas activas
+        Index(
+            'ix_zonas_usuario_fecha',
+            'usuario_id',
+            text('fecha_creacion DESC'),
+            text('id DESC'),
+            postgresql_where=text('activa'),
+        ),
+    )
+    
     id = Column(Integer, primary_key=True, index=True)
     usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False, index=True)
 
@@ -40,6 +59,49 @@ class ZonaPeligrosaUsuario(Base):
     # Relación con Usuario
     usuario = relationship("Usuario", back_populates="zonas_peligrosas")
     
+    # Huella "nombre:lat:lon" calculada en Postgres (solo con with_expression(..., HUELLA_ZONA))
+    huella = query_expression()
+    
+    @property
+    def centro(self):
+        """Centro de la zona: el primer punto del polígono (o None si no tiene)"""
+        return self.poligono[0] if self.poligono else None
+    
     def __repr__(self):
         return f"<ZonaPeligrosa(id={self.id}, usuario={self.usuario_id}, nombre='{self.nombre}', nivel={self.nivel_peligro})>"
 
+
+
+# Mismas expresiones que ix_zonas_centro, para usarlas en los filtros
+CENTRO_LAT = literal_column("(poligono -> 0 ->> 'lat')::float8", Float)
+CENTRO_LON = literal_column("(poligono -> 0 ->> 'lon')::float8", Float)
+
+def _coordenada_redondeada(clave: str):
+    return cast(func.round(literal_column(f"(poligono -> 0 ->> '{clave}')::numeric", Numeric), 5), String)
+
+# Huella para detectar zonas adoptadas: nombre normalizado + centro redondeado a 5 decimales
+# (NULL si la zona no tiene centro)
+HUELLA_ZONA = (
+    func.lower(func.trim(ZonaPeligrosaUsuario.nombre)) + ':' +
+    _coordenada_redondeada('lat') + ':' +
+    _coordenada_redondeada('lon')
+)
+
+def filtro_centro_cerca(lat: float, lon: float, radio_metros: float) -> list:
+    """
+    Condiciones SQL: centro de la zona a menos de radio_metros del punto.
+    La caja usa ix_zonas_centro y Haversine (la misma fórmula de geometria) se evalúa
+    en Postgres solo sobre las filas de la caja.
+    """
+    caja = calcular_caja_radio(lat, lon, radio_metros)
+    medio_dlat = func.radians(CENTRO_LAT - lat) / 2
+    medio_dlon = func.radians(CENTRO_LON - lon) / 2
+    a = (
+        func.power(func.sin(medio_dlat), 2) +
+        math.cos(math.radians(lat)) * func.cos(func.radians(CENTRO_LAT)) * func.power(func.sin(medio_dlon), 2)
+    )
+    return [
+        CENTRO_LAT.between(caja['min_lat'], caja['max_lat']),
+        CENTRO_LON.between(caja['min_lon'], caja['max_lon']),
+        6371000 * 2 * func.asin(func.sqrt(a)) <= radio_metros,
+    ]
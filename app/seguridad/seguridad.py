@@ -1,11 +1,17 @@
+import base64
 import logging
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+import threading
+from datetime import datetime
+from cachetools import TTLCache
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from pydantic import TypeAdapter
+from sqlalchemy import and_, tuple_
+from sqlalchemy.orm import Session, with_expression
+from typing import List, NamedTuple, Optional, FrozenSet, Tuple
 
 from ..database.database import get_db
 from ..usuarios.security import get_current_user
-from .models import ZonaPeligrosaUsuario
+from .models import ZonaPeligrosaUsuario, HUELLA_ZONA, filtro_centro_cerca
 from .seguridad_schemas import *
 from .validador_seguridad_personal import *
 from ..services.ucb_service import UCBService
@@ -31,6 +37,45 @@ def traducir_tipo_ruta(tipo_ingles: str) -> str:
     }
     return traducciones.get(tipo_ingles, tipo_ingles)
 
+
+# Copia inmutable de una zona propia (lo que usa la validación de rutas)
+class ZonaPropia(NamedTuple):
+    id: int
+    nombre: str
+    nivel_peligro: int
+    tipo: Optional[str]
+    notas: Optional[str]
+    radio_metros: Optional[int]
+    centro: Optional[dict]
+    huella: Optional[str]
+
+class ZonasPropiasUsuario(NamedTuple):
+    zonas: Tuple[ZonaPropia, ...]
+    ids: FrozenSet[int]
+    huellas: FrozenSet[str]
+
+# Zonas activas de cada usuario para /validar-rutas; se invalida al modificar sus zonas
+_zonas_propias_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_zonas_propias_lock = threading.Lock()
+_zonas_propias_generacion = 0
+
+def _zonas_propias_snapshot(zonas) -> ZonasPropiasUsuario:
+    copias = tuple(
+        ZonaPropia(z.id, z.nombre, z.nivel_peligro, z.tipo, z.notas, z.radio_metros, z.centro, z.huella)
+        for z in zonas
+    )
+    return ZonasPropiasUsuario(
+        zonas=copias,
+        ids=frozenset(z.id for z in copias),
+        huellas=frozenset(z.huella for z in copias if z.huella is not None)
+    )
+
+def invalidar_zonas_propias(usuario_id: int):
+    global _zonas_propias_generacion
+    with _zonas_propias_lock:
+        _zonas_propias_generacion += 1
+        _zonas_propias_cache.pop(usuario_id, None)
+
 # ==========================================
 # 1. MARCAR ZONA PELIGROSA
 # ==========================================
@@ -76,6 +121,7 @@ def marcar_zona_peligrosa(
         
         db.add(nueva_zona)
         db.commit()
+        invalidar_zonas_propias(current_user.id)
         db.refresh(nueva_zona)
         
         logger.info(f"✅ Usuario {current_user.id} marcó zona peligrosa: '{zona.nombre}' "
@@ -97,9 +143,27 @@ def marcar_zona_peligrosa(
 # 2. OBTENER MIS ZONAS PELIGROSAS
 # ==========================================
 
+_LISTA_ZONAS_ADAPTER = TypeAdapter(List[ZonaPeligrosaResponse])
+
+def _codificar_cursor(zona) -> str:
+    """Cursor opaco con la posición (fecha_creacion, id) de la última zona de la página"""
+    return base64.urlsafe_b64encode(f"{zona.fecha_creacion.isoformat()}|{zona.id}".encode()).decode()
+
+def _decodificar_cursor(cursor: str):
+    try:
+        fecha, zona_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(fecha), int(zona_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor inválido"
+        )
+
 @router.get("/mis-zonas", response_model=List[ZonaPeligrosaResponse])
 def obtener_mis_zonas_peligrosas(
     activas_solo: bool = True,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
@@ -108,6 +172,8 @@ def obtener_mis_zonas_peligrosas(
     
     **Parámetros:**
     - **activas_solo**: Si True, solo devuelve zonas activas
+    - **limit**: Tamaño de página (opcional; sin limit se devuelven todas)
+    - **cursor**: Valor del header X-Next-Cursor de la página anterior
     """
     try:
         query = db.query(ZonaPeligrosaUsuario).filter(
@@ -117,11 +183,40 @@ def obtener_mis_zonas_peligrosas(
         if activas_solo:
             query = query.filter(ZonaPeligrosaUsuario.activa == True)
         
-        zonas = query.order_by(ZonaPeligrosaUsuario.fecha_creacion.desc()).all()
+        # Paginación keyset: continuar después de la última zona entregada (sin OFFSET)
+        if cursor:
+            query = query.filter(
+                tuple_(ZonaPeligrosaUsuario.fecha_creacion, ZonaPeligrosaUsuario.id) < _decodificar_cursor(cursor)
+            )
+        
+        query = query.order_by(
+            ZonaPeligrosaUsuario.fecha_creacion.desc(),
+            ZonaPeligrosaUsuario.id.desc()
+        )
+        
+        if limit:
+            query = query.limit(limit)
+        
+        zonas = query.all()
         
         logger.info(f"Usuario {current_user.id} consultó {len(zonas)} zonas peligrosas")
-        return zonas
         
+        # Página llena: puede haber más zonas
+        headers = None
+        if limit and len(zonas) == limit:
+            headers = {"X-Next-Cursor": _codificar_cursor(zonas[-1])}
+        
+        # Validar y serializar en una sola pasada (sin revalidar la respuesta en FastAPI)
+        return Response(
+            content=_LISTA_ZONAS_ADAPTER.dump_json(
+                _LISTA_ZONAS_ADAPTER.validate_python(zonas, from_attributes=True)
+            ),
+            media_type="application/json",
+            headers=headers
+        )
+        
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error obteniendo zonas: {e}", exc_info=True)
         raise HTTPException(
@@ -144,10 +239,35 @@ def validar_rutas_seguridad(
     current_user = Depends(get_current_user)
 ):
     try:
-        # 1️⃣ Obtener ubicación del destino
-        ubicacion_destino = db.query(UbicacionUsuario).filter(
-            UbicacionUsuario.id == request.ubicacion_id
-        ).first()
+        # 1️⃣ + 2️⃣ Ubicación del destino y zonas PROPIAS del usuario
+        with _zonas_propias_lock:
+            propias = _zonas_propias_cache.get(current_user.id)
+            generacion = _zonas_propias_generacion
+        
+        if propias is None:
+            # Una sola consulta (LEFT OUTER JOIN: la ubicación viene aunque el usuario no tenga zonas)
+            filas = db.query(UbicacionUsuario, ZonaPeligrosaUsuario).outerjoin(
+                ZonaPeligrosaUsuario,
+                and_(
+                    ZonaPeligrosaUsuario.usuario_id == current_user.id,
+                    ZonaPeligrosaUsuario.activa == True
+                )
+            ).filter(
+                UbicacionUsuario.id == request.ubicacion_id
+            ).options(
+                with_expression(ZonaPeligrosaUsuario.huella, HUELLA_ZONA)
+            ).all()
+            
+            ubicacion_destino = filas[0][0] if filas else None
+            if filas:
+                propias = _zonas_propias_snapshot(zona for _, zona in filas if zona is not None)
+                with _zonas_propias_lock:
+                    if generacion == _zonas_propias_generacion:
+                        _zonas_propias_cache[current_user.id] = propias
+        else:
+            ubicacion_destino = db.query(UbicacionUsuario).filter(
+                UbicacionUsuario.id == request.ubicacion_id
+            ).first()
         
         if not ubicacion_destino:
             raise HTTPException(
@@ -155,59 +275,29 @@ def validar_rutas_seguridad(
                 detail="Ubicación de destino no encontrada"
             )
         
-        # 2️⃣ Obtener zonas PROPIAS del usuario
-        validador = ValidadorSeguridadPersonal(db, current_user.id)
-        zonas_propias = db.query(ZonaPeligrosaUsuario).filter(
-            ZonaPeligrosaUsuario.usuario_id == current_user.id,
-            ZonaPeligrosaUsuario.activa == True
-        ).all()
+        zonas_propias = propias.zonas
+        # El validador reutiliza estas zonas en lugar de volver a consultarlas
+        validador = ValidadorSeguridadPersonal(db, current_user.id, zonas=zonas_propias)
 
-        # 🔥 CREAR SET DE IDs Y TAMBIÉN SET DE "HUELLAS" (nombre + coordenadas)
-        zonas_ids_propias = {z.id for z in zonas_propias}
-
-        # Crear huellas únicas para detectar zonas adoptadas (mismo nombre + coordenadas)
-        def crear_huella_zona(zona):
-            """Crea una huella única para comparar zonas (nombre + centro)"""
-            if not zona.poligono:
-                return None
-            centro = zona.poligono[0]
-            # Redondear a 5 decimales para evitar diferencias mínimas
-            lat = round(centro['lat'], 5)
-            lon = round(centro['lon'], 5)
-            return f"{zona.nombre.lower().strip()}:{lat}:{lon}"
-
-        huellas_propias = {
-            crear_huella_zona(z) for z in zonas_propias 
-            if crear_huella_zona(z) is not None
-        }
+        # 🔥 SET DE IDs Y SET DE "HUELLAS" (nombre + coordenadas) para detectar zonas adoptadas;
+        # Postgres calcula las huellas al cargar las zonas (HUELLA_ZONA)
+        zonas_ids_propias = propias.ids
+        huellas_propias = propias.huellas
 
         logger.info(f"🔒 Zonas propias del usuario: {len(zonas_propias)}")
         logger.debug(f"🔍 Huellas propias: {huellas_propias}")
         
         # 3️⃣ 🚀 NUEVO: Obtener zonas PÚBLICAS cerca del DESTINO
-        from .geometria import calcular_distancia_haversine
-
-        zonas_publicas_cercanas = db.query(ZonaPeligrosaUsuario).filter(
+        # El radio de 10km se filtra en SQL (caja indexada + Haversine en Postgres)
+        radio_busqueda_metros = 10_000  # 10km
+        zonas_publicas_filtradas = db.query(ZonaPeligrosaUsuario).filter(
             ZonaPeligrosaUsuario.usuario_id != current_user.id,
-            ZonaPeligrosaUsuario.activa == True
+            ZonaPeligrosaUsuario.activa == True,
+            *filtro_centro_cerca(ubicacion_destino.latitud, ubicacion_destino.longitud, radio_busqueda_metros)
+        ).options(
+            with_expression(ZonaPeligrosaUsuario.huella, HUELLA_ZONA)
         ).all()
-
-        # Filtrar por distancia al destino (10km)
-        zonas_publicas_filtradas = []
-        radio_busqueda_metros = 10_000  # 10km
-
-        for zona in zonas_publicas_cercanas:
-            centro = zona.poligono[0] if zona.poligono else None
-            if not centro:
-                continue
-            
-            distancia = calcular_distancia_haversine(
-                ubicacion_destino.latitud, ubicacion_destino.longitud,
-                centro['lat'], centro['lon']
-            )
-            
-            if distancia <= radio_busqueda_metros:
-                zonas_publicas_filtradas.append(zona)
+        distancia_al_destino = distancia_desde(ubicacion_destino.latitud, ubicacion_destino.longitud)
         
         logger.info(f"🌍 Zonas públicas cerca del destino: {len(zonas_publicas_filtradas)}")
         
@@ -222,13 +312,34 @@ def validar_rutas_seguridad(
         
         # 5️⃣ Validar cada ruta contra TODAS las zonas (propias + públicas)
         rutas_validadas = []
+        
+        # Descartar una sola vez (no por cada ruta) las zonas públicas que ya son del usuario
+        zonas_publicas_ajenas = []
+        for zona_publica in zonas_publicas_filtradas:
+            # 🔥 VERIFICACIÓN 1: Saltar si es del usuario (por ID)
+            if zona_publica.id in zonas_ids_propias:
+                logger.debug(f"⏭️ Saltando zona {zona_publica.id} (es del usuario por ID)")
+                continue
+            
+            # 🔥 VERIFICACIÓN 2: Saltar si es una zona ADOPTADA (mismo nombre + coords)
+            if zona_publica.huella in huellas_propias:
+                logger.debug(f"⏭️ Saltando zona '{zona_publica.nombre}' (adoptada por el usuario)")
+                continue
+            
+            zonas_publicas_ajenas.append(zona_publica)
+        
+        indice_publicas = validador.construir_indice(zonas_publicas_ajenas)
 
         for ruta in request.rutas:
-            puntos_ruta = validador._decode_polyline(ruta.geometry)
+            # Puntos ya decodificados por el cliente si los envía; si no, decodificar la polyline
+            if ruta.geometry_points is not None:
+                puntos_ruta = [{'lat': lat, 'lon': lon} for lat, lon in ruta.geometry_points]
+            else:
+                puntos_ruta = validador._decode_polyline(ruta.geometry)
             
             # Validar contra zonas PROPIAS
-            validacion_propias = validador.validar_ruta(
-                geometry_polyline=ruta.geometry,
+            validacion_propias = validador.validar_ruta_decoded(
+                puntos_ruta,
                 metadata={
                     'tipo': ruta.tipo,
                     'distance': ruta.distance,
@@ -239,18 +350,8 @@ def validar_rutas_seguridad(
             # 🚀 VALIDAR CONTRA ZONAS PÚBLICAS
             zonas_publicas_detectadas = []
 
-            for zona_publica in zonas_publicas_filtradas:
-                # 🔥 VERIFICACIÓN 1: Saltar si es del usuario (por ID)
-                if zona_publica.id in zonas_ids_propias:
-                    logger.debug(f"⏭️ Saltando zona {zona_publica.id} (es del usuario por ID)")
-                    continue
-                
-                # 🔥 VERIFICACIÓN 2: Saltar si es una zona ADOPTADA (mismo nombre + coords)
-                huella_publica = crear_huella_zona(zona_publica)
-                if huella_publica and huella_publica in huellas_propias:
-                    logger.debug(f"⏭️ Saltando zona '{zona_publica.nombre}' (adoptada por el usuario)")
-                    continue
-                
+            # Solo las zonas públicas cuyas celdas toca la ruta (índice espacial)
+            for zona_publica in indice_publicas.candidatos(puntos_ruta):
                 # Validar intersección
                 resultado_zona = validador._analizar_zona_con_deteccion_puentes(
                     zona_publica,
@@ -263,12 +364,9 @@ def validar_rutas_seguridad(
                 )
                 
                 if resultado_zona['es_interseccion_real']:
-                    centro = zona_publica.poligono[0] if zona_publica.poligono else None
+                    centro = zona_publica.centro
                     if centro:
-                        distancia_km = calcular_distancia_haversine(
-                            ubicacion_destino.latitud, ubicacion_destino.longitud,
-                            centro['lat'], centro['lon']
-                        ) / 1000.0
+                        distancia_km = distancia_al_destino(centro['lat'], centro['lon']) / 1000.0
 
                         zonas_publicas_detectadas.append({
                             'zona_id': zona_publica.id,
@@ -336,18 +434,18 @@ def validar_rutas_seguridad(
             
             rutas_validadas.append(ruta_validada)
         
-        # 6️⃣ Determinar mejor ruta y advertencias
-        todas_seguras = all(rv.es_segura for rv in rutas_validadas)
-        
+        # 6️⃣ Determinar mejor ruta y advertencias (una sola pasada)
+        todas_seguras = True
         mejor_ruta_segura = None
         ruta_menos_peligrosa = None
         nivel_riesgo_minimo = 999
         
         for rv in rutas_validadas:
             if rv.es_segura:
-                mejor_ruta_segura = rv.tipo
-                break
+                if mejor_ruta_segura is None:
+                    mejor_ruta_segura = rv.tipo
             else:
+                todas_seguras = False
                 if rv.nivel_riesgo < nivel_riesgo_minimo:
                     nivel_riesgo_minimo = rv.nivel_riesgo
                     ruta_menos_peligrosa = rv.tipo
@@ -438,6 +536,7 @@ def actualizar_zona_peligrosa(
             zona.activa = zona_update.activa
         
         db.commit()
+        invalidar_zonas_propias(current_user.id)
         db.refresh(zona)
         
         logger.info(f"✅ Usuario {current_user.id} actualizó zona {zona_id}")
@@ -482,6 +581,7 @@ def eliminar_zona_peligrosa(
         
         db.delete(zona)
         db.commit()
+        invalidar_zonas_propias(current_user.id)
         
         logger.info(f"🗑️ Usuario {current_user.id} eliminó zona {zona_id}")
         return None
@@ -554,6 +654,7 @@ def toggle_zona_activa(
         
         zona.activa = not zona.activa
         db.commit()
+        invalidar_zonas_propias(current_user.id)
         db.refresh(zona)
         
         estado = "activada" if zona.activa else "desactivada"
@@ -597,7 +698,6 @@ def verificar_ubicacion_actual(
     """
     try:
         from .models import ZonaPeligrosaUsuario
-        from .geometria import calcular_distancia_haversine
         
         # 1. Obtener zonas activas del usuario
         zonas = db.query(ZonaPeligrosaUsuario).filter(
@@ -615,20 +715,18 @@ def verificar_ubicacion_actual(
         # 2. Verificar cada zona
         zonas_detectadas = []
         nivel_peligro_maximo = 0
+        distancia_al_usuario = distancia_desde(request.lat, request.lon)
         
         for zona in zonas:
             # Obtener centro de la zona (primer punto del polígono)
-            centro = zona.poligono[0] if zona.poligono else None
+            centro = zona.centro
             if not centro:
                 continue
             
             radio_zona = zona.radio_metros or 200
             
             # Calcular distancia al centro
-            distancia = calcular_distancia_haversine(
-                request.lat, request.lon,
-                centro['lat'], centro['lon']
-            )
+            distancia = distancia_al_usuario(centro['lat'], centro['lon'])
             
             # ¿Está dentro del radio?
             dentro = distancia <= radio_zona
@@ -690,52 +788,20 @@ def obtener_zonas_sugeridas(
     **Caso de uso:** Usuario de Guayaquil visita Quevedo
     """
     try:
-        from .geometria import calcular_distancia_haversine
-        
-        # 1. Obtener TODAS las zonas activas de OTROS usuarios
+        # 1. Obtener las zonas activas de OTROS usuarios dentro del radio (filtrado en SQL)
+        radio_metros = radio_km * 1000
         zonas_publicas = db.query(ZonaPeligrosaUsuario).filter(
             ZonaPeligrosaUsuario.usuario_id != current_user.id,
-            ZonaPeligrosaUsuario.activa == True
+            ZonaPeligrosaUsuario.activa == True,
+            *filtro_centro_cerca(lat, lon, radio_metros)
         ).all()
         
-        logger.info(f"📊 Total zonas públicas en BD: {len(zonas_publicas)}")
-        
-        # 2. Obtener IDs de zonas que el usuario YA tiene
-        zonas_propias = db.query(ZonaPeligrosaUsuario.id).filter(
-            ZonaPeligrosaUsuario.usuario_id == current_user.id,
-            ZonaPeligrosaUsuario.activa == True
-        ).all()
-        
-        ids_propias = {z.id for z in zonas_propias}
-        logger.info(f"🔒 Usuario tiene {len(ids_propias)} zonas propias")
-        
-        # 3. Filtrar zonas cercanas
-        zonas_cercanas = []
-        radio_metros = radio_km * 1000
-        
-        for zona in zonas_publicas:
-            # Saltar si el usuario ya tiene esta zona (caso improbable pero posible)
-            if zona.id in ids_propias:
-                continue
-            
-            # Obtener centro de la zona
-            centro = zona.poligono[0] if zona.poligono else None
-            if not centro:
-                continue
-            
-            # Calcular distancia
-            distancia = calcular_distancia_haversine(
-                lat, lon,
-                centro['lat'], centro['lon']
-            )
-            
-            # ¿Está dentro del radio?
-            if distancia <= radio_metros:
-                zonas_cercanas.append(zona)
+        logger.info(f"📊 Zonas públicas dentro del radio: {len(zonas_publicas)}")
         
-        logger.info(f"✅ {len(zonas_cercanas)} zonas sugeridas para mostrar")
+        # Las zonas del usuario ya quedan fuera por usuario_id != current_user.id
+        logger.info(f"✅ {len(zonas_publicas)} zonas sugeridas para mostrar")
         
-        return zonas_cercanas
+        return zonas_publicas
         
     except Exception as e:
         logger.error(f"Error obteniendo zonas sugeridas: {e}", exc_info=True)
@@ -807,6 +873,7 @@ def adoptar_zona_sugerida(
         
         db.add(nueva_zona)
         db.commit()
+        invalidar_zonas_propias(current_user.id)
         db.refresh(nueva_zona)
         
         logger.info(f"✅ Usuario {current_user.id} adoptó zona '{nueva_zona.nombre}' (ID: {nueva_zona.id})")
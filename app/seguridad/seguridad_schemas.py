@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict
+from pydantic import BaseModel, ConfigDict, Field, validator
+from typing import List, Optional, Dict, Tuple
 from datetime import datetime
 
 class PuntoGeografico(BaseModel):
@@ -39,13 +39,15 @@ class ZonaPeligrosaResponse(BaseModel):
     notas: Optional[str]
     radio_metros: Optional[int]
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
         
 class RutaParaValidar(BaseModel):
     """Ruta que será validada"""
     tipo: str = Field(..., description="fastest, shortest, recommended")
-    geometry: str = Field(..., description="Polyline encoded de la ruta")
+    geometry: Optional[str] = Field(None, description="Polyline encoded de la ruta")
+    geometry_points: Optional[List[Tuple[float, float]]] = Field(
+        None, description="Puntos (lat, lon) ya decodificados; si vienen, se usan en lugar de geometry"
+    )
     distance: Optional[float] = Field(None, description="Distancia en metros")
     duration: Optional[float] = Field(None, description="Duración en segundos")
 
@@ -79,6 +81,13 @@ class ValidarRutasRequest(BaseModel):
             raise ValueError("No puede haber rutas con el mismo tipo")
         return rutas
 
+    @validator('rutas')
+    def validar_geometrias(cls, rutas):
+        for r in rutas:
+            if r.geometry is None and r.geometry_points is None:
+                raise ValueError(f"La ruta '{r.tipo}' necesita geometry o geometry_points")
+        return rutas
+
 class ValidarRutasResponse(BaseModel):
     """Response con rutas validadas"""
     rutas_validadas: List[RutaValidada]
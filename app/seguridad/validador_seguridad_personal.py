@@ -1,9 +1,12 @@
 import logging
 from typing import List, Dict, Tuple, Optional
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from datetime import datetime
 import math
 
+from .geometria import calcular_caja_radio, distancia_desde, IndiceCuadricula
+
 logger = logging.getLogger(__name__)
 
 class ValidadorSeguridadPersonal:
@@ -11,11 +14,14 @@ class ValidadorSeguridadPersonal:
     🔒 Validador de rutas con detección inteligente de puentes
     """
     
-    def __init__(self, db: Session, usuario_id: int):
+    def __init__(self, db: Session, usuario_id: int, zonas: Optional[List] = None):
         self.db = db
         self.usuario_id = usuario_id
-        self._cache_zonas = None
-        self._cache_timestamp = None
+        # Si el llamador ya cargó las zonas activas del usuario, se usan como caché
+        self._cache_zonas = zonas
+        self._cache_timestamp = datetime.now() if zonas is not None else None
+        self._cajas_zonas = {}  # zona.id -> bounding box del círculo de la zona
+        self._indice_propias = None  # IndiceCuadricula de las zonas propias en caché
         
         # 🔥 PARÁMETROS DE DETECCIÓN DE PUENTES
         self.RADIO_VERIFICACION_PUENTE = 200
@@ -40,6 +46,7 @@ class ValidadorSeguridadPersonal:
         
         self._cache_zonas = zonas
         self._cache_timestamp = ahora
+        self._indice_propias = None
         
         logger.info(f"Usuario {self.usuario_id}: {len(zonas)} zonas peligrosas activas cargadas")
         return zonas
@@ -48,6 +55,13 @@ class ValidadorSeguridadPersonal:
         """
         🔥 VALIDACIÓN MEJORADA CON DETECCIÓN DE PUENTES
         """
+        return self.validar_ruta_decoded(self._decode_polyline(geometry_polyline), metadata)
+    
+    def validar_ruta_decoded(self, puntos_ruta: List[Dict], metadata: Dict = None) -> Dict:
+        """
+        Igual que validar_ruta, pero con la ruta ya decodificada
+        (para no decodificar la misma polilínea dos veces)
+        """
         try:
             zonas_peligrosas = self._get_zonas_peligrosas_usuario()
             
@@ -59,9 +73,6 @@ class ValidadorSeguridadPersonal:
                     'mensaje': None
                 }
             
-            # Decodificar ruta
-            puntos_ruta = self._decode_polyline(geometry_polyline)
-            
             if not puntos_ruta:
                 return {
                     'es_segura': True,
@@ -75,8 +86,11 @@ class ValidadorSeguridadPersonal:
             zonas_detectadas = []
             nivel_riesgo_maximo = 0
             
-            # Analizar cada zona
-            for zona in zonas_peligrosas:
+            if self._indice_propias is None:
+                self._indice_propias = self.construir_indice(zonas_peligrosas)
+            
+            # Analizar solo las zonas cuyas celdas toca la ruta (índice espacial)
+            for zona in self._indice_propias.candidatos(puntos_ruta):
                 resultado_zona = self._analizar_zona_con_deteccion_puentes(
                     zona, 
                     puntos_ruta,
@@ -127,6 +141,29 @@ class ValidadorSeguridadPersonal:
                 'error': str(e)
             }
     
+    def _caja_zona(self, zona) -> Optional[Dict]:
+        """Bounding box del círculo de la zona (centro ± radio), calculada una vez por zona"""
+        caja_zona = self._cajas_zonas.get(zona.id)
+        if caja_zona is None:
+            centro = zona.centro
+            if not centro:
+                return None
+            caja_zona = calcular_caja_radio(centro['lat'], centro['lon'], zona.radio_metros or 200)
+            self._cajas_zonas[zona.id] = caja_zona
+        return caja_zona
+    
+    def construir_indice(self, zonas: List) -> IndiceCuadricula:
+        """
+        Índice por celdas de las zonas: cada ruta solo se analiza contra las zonas
+        cuyas celdas contienen alguno de sus puntos (las demás no pueden tener puntos dentro)
+        """
+        indice = IndiceCuadricula()
+        for zona in zonas:
+            caja_zona = self._caja_zona(zona)
+            if caja_zona is not None:
+                indice.agregar(zona, caja_zona)
+        return indice
+    
     def _analizar_zona_con_deteccion_puentes(
         self, 
         zona, 
@@ -140,7 +177,7 @@ class ValidadorSeguridadPersonal:
         """
         
         # Datos de la zona
-        centro = zona.poligono[0] if zona.poligono else None
+        centro = zona.centro
         if not centro:
             return {'es_interseccion_real': False, 'porcentaje': 0, 'distancia_minima': float('inf')}
         
@@ -152,12 +189,10 @@ class ValidadorSeguridadPersonal:
         distancias_al_centro = []
         indices_puntos_dentro = []
         
-        # Analizar cada punto
+        # Analizar cada punto (zona circular: basta la distancia al centro contra el radio)
+        distancia_al_centro = distancia_desde(centro['lat'], centro['lon'])
         for i, punto in enumerate(puntos_ruta):
-            distancia = self._calcular_distancia_haversine(
-                punto['lat'], punto['lon'],
-                centro['lat'], centro['lon']
-            )
+            distancia = distancia_al_centro(punto['lat'], punto['lon'])
             
             distancias_al_centro.append(distancia)
             
@@ -195,10 +230,8 @@ class ValidadorSeguridadPersonal:
         
         # 🔥 ESTRATEGIA 4: Análisis de entrada/salida
         patron_entrada_salida = self._analizar_patron_entrada_salida(
-            puntos_ruta,
             indices_puntos_dentro,
-            centro,
-            radio_zona
+            distancias_al_centro
         )
         
         # 🎯 DECISIÓN FINAL: ¿Es intersección real o solo un puente?
@@ -327,27 +360,19 @@ class ValidadorSeguridadPersonal:
     
     def _analizar_patron_entrada_salida(
         self,
-        puntos_ruta: List[Dict],
         indices_dentro: List[int],
-        centro: Dict,
-        radio: float
+        distancias_al_centro: List[float]
     ) -> Dict:
         """
         Analiza el patrón de cómo la ruta entra y sale de la zona
+        (reutiliza las distancias al centro ya calculadas para cada punto)
         """
         
         if len(indices_dentro) < 3:
             return {'transito_lento': False, 'entrada_gradual': False}
         
-        # Analizar distancias al centro en los puntos dentro
-        distancias_dentro = []
-        for idx in indices_dentro:
-            punto = puntos_ruta[idx]
-            dist = self._calcular_distancia_haversine(
-                punto['lat'], punto['lon'],
-                centro['lat'], centro['lon']
-            )
-            distancias_dentro.append(dist)
+        # Distancias al centro en los puntos dentro
+        distancias_dentro = [distancias_al_centro[idx] for idx in indices_dentro]
         
         # ¿Hay tránsito lento? (varios puntos muy cerca entre sí)
         puntos_muy_juntos = sum(1 for d in distancias_dentro if d < 30)
@@ -424,37 +449,39 @@ class ValidadorSeguridadPersonal:
         lng = 0
         
         try:
-            while index < len(encoded):
-                b = 0
+            # Bytes en lugar de str: indexar da el entero directo (sin ord() por carácter)
+            datos = encoded.encode()
+            total = len(datos)
+            agregar = points.append
+            
+            while index < total:
                 shift = 0
                 result = 0
                 
                 while True:
-                    b = ord(encoded[index]) - 63
+                    b = datos[index] - 63
                     index += 1
                     result |= (b & 0x1f) << shift
                     shift += 5
                     if b < 0x20:
                         break
                 
-                dlat = ~(result >> 1) if (result & 1) else (result >> 1)
-                lat += dlat
+                lat += ~(result >> 1) if (result & 1) else (result >> 1)
                 
                 shift = 0
                 result = 0
                 
                 while True:
-                    b = ord(encoded[index]) - 63
+                    b = datos[index] - 63
                     index += 1
                     result |= (b & 0x1f) << shift
                     shift += 5
                     if b < 0x20:
                         break
                 
-                dlng = ~(result >> 1) if (result & 1) else (result >> 1)
-                lng += dlng
+                lng += ~(result >> 1) if (result & 1) else (result >> 1)
                 
-                points.append({
+                agregar({
                     'lat': lat / 1e5,
                     'lon': lng / 1e5
                 })
@@ -468,24 +495,37 @@ class ValidadorSeguridadPersonal:
     def obtener_estadisticas_seguridad(self) -> Dict:
         """Obtiene estadísticas de seguridad del usuario"""
         from .models import ZonaPeligrosaUsuario
-                
-        zonas = self.db.query(ZonaPeligrosaUsuario).filter(
+        
+        # Conteos agregados en SQL: una fila por combinación (tipo, nivel, activa)
+        grupos = self.db.query(
+            ZonaPeligrosaUsuario.tipo,
+            ZonaPeligrosaUsuario.nivel_peligro,
+            ZonaPeligrosaUsuario.activa,
+            func.count()
+        ).filter(
             ZonaPeligrosaUsuario.usuario_id == self.usuario_id
+        ).group_by(
+            ZonaPeligrosaUsuario.tipo,
+            ZonaPeligrosaUsuario.nivel_peligro,
+            ZonaPeligrosaUsuario.activa
         ).all()
         
+        total_zonas = 0
+        zonas_activas = 0
         zonas_por_tipo = {}
-        for zona in zonas:
-            tipo = zona.tipo or 'otro'
-            zonas_por_tipo[tipo] = zonas_por_tipo.get(tipo, 0) + 1
-        
         zonas_por_nivel = {}
-        for zona in zonas:
-            zonas_por_nivel[zona.nivel_peligro] = zonas_por_nivel.get(zona.nivel_peligro, 0) + 1
+        for tipo, nivel_peligro, activa, cantidad in grupos:
+            total_zonas += cantidad
+            if activa:
+                zonas_activas += cantidad
+            tipo = tipo or 'otro'
+            zonas_por_tipo[tipo] = zonas_por_tipo.get(tipo, 0) + cantidad
+            zonas_por_nivel[nivel_peligro] = zonas_por_nivel.get(nivel_peligro, 0) + cantidad
         
         return {
-            'total_zonas': len(zonas),
-            'zonas_activas': len([z for z in zonas if z.activa]),
-            'zonas_inactivas': len([z for z in zonas if not z.activa]),
+            'total_zonas': total_zonas,
+            'zonas_activas': zonas_activas,
+            'zonas_inactivas': total_zonas - zonas_activas,
             'zonas_por_tipo': zonas_por_tipo,
             'zonas_por_nivel': zonas_por_nivel
         }
\ No newline at end of file
@@ -1,58 +1,146 @@
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from jose import jwt, JWTError, ExpiredSignatureError
+from jose import jwt, jwk, JWTError, ExpiredSignatureError
 import os
 import secrets
+import hashlib
+import base64
+import threading
+import time
+from typing import NamedTuple
+from cachetools import TTLCache, TLRUCache
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, WebSocket
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 
 from ..usuarios.models import Usuario
+from .sesiones.models import SesionAppUsuario
 from ..database.database import get_db
 
-# bcrypt
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# argon2id para hashes nuevos; los bcrypt existentes se siguen verificando
+# y se re-hashean a argon2 en el siguiente login exitoso (needs_update)
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1
+)
 
 # JWT
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
+# Clave ya construida una sola vez; jose la reutiliza en lugar de parsear SECRET_KEY en cada encode/decode
+SIGNING_KEY = jwk.construct(SECRET_KEY, ALGORITHM) if SECRET_KEY else SECRET_KEY
 
 # Expiraciones
 ACCESS_TOKEN_EXPIRE_MINUTES = 15           # Access token 15 minutos
 REFRESH_TOKEN_EXPIRE_DAYS = 180            # Refresh token 6 meses
 
+# Los endpoints de login son "def" y ya corren en el threadpool de FastAPI (fuera del
+# event loop); el hash libera el GIL, así que solo se limita a un hash por núcleo para
+# que una ráfaga de logins no sobresuscriba la CPU.
+_HASH_SLOTS = threading.BoundedSemaphore(os.cpu_count() or 1)
+
 # Hash de password
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    with _HASH_SLOTS:
+        return pwd_context.hash(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    with _HASH_SLOTS:
+        return pwd_context.verify(plain_password, hashed_password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    return pwd_context.needs_update(hashed_password)
+
+# Verificaciones exitosas recientes: evita repetir bcrypt en logins seguidos.
+# La clave usa un hash con pepper aleatorio por proceso (nunca la contraseña en claro)
+# e incluye el hash guardado, así un cambio de contraseña invalida la entrada.
+_PEPPER = secrets.token_bytes(32)
+_verificaciones_cache: TTLCache = TTLCache(maxsize=4096, ttl=300)
+_verificaciones_lock = threading.Lock()
+
+def verify_password_cached(plain_password: str, hashed_password: str) -> bool:
+    clave = (
+        hashlib.blake2b(plain_password.encode(), key=_PEPPER, digest_size=16).digest(),
+        hashed_password
+    )
+    with _verificaciones_lock:
+        if clave in _verificaciones_cache:
+            return True
+
+    if not verify_password(plain_password, hashed_password):
+        return False
+
+    with _verificaciones_lock:
+        _verificaciones_cache[clave] = True
+    return True
 
 # Crear access token JWT
 def create_access_token(data: dict, expires_delta: int = ACCESS_TOKEN_EXPIRE_MINUTES):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=expires_delta)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
-# Crear refresh token aleatorio
-def create_refresh_token():
-    return secrets.token_urlsafe(64)
+    return jwt.encode(to_encode, SIGNING_KEY, algorithm=ALGORITHM)
+
+# Refresh token opaco (64 bytes aleatorios, 86 caracteres como token_urlsafe(64)):
+# no lleva datos del usuario y la sesión en BD decide siempre si es válido
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+# Bytes aleatorios leídos de os.urandom en bloques de 4 KiB para no hacer una
+# llamada al sistema por cada token emitido
+_ALEATORIOS_BLOQUE = 4096
+_aleatorios = bytearray()
+_aleatorios_lock = threading.Lock()
+
+def _bytes_aleatorios(n: int) -> bytes:
+    global _aleatorios
+    with _aleatorios_lock:
+        if len(_aleatorios) < n:
+            _aleatorios = bytearray(os.urandom(_ALEATORIOS_BLOQUE))
+        datos = bytes(_aleatorios[:n])
+        del _aleatorios[:n]
+    return datos
+
+def create_refresh_token() -> str:
+    return _b64(_bytes_aleatorios(64))
 
 # OAuth2 para leer token del header
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login/")
 
+# Tokens ya verificados: token -> payload. Cada entrada vive como máximo
+# TOKEN_CACHE_SECONDS y nunca más allá del "exp" del propio token.
+TOKEN_CACHE_SECONDS = 15
+
+def _vigencia_token(token: str, payload: dict, ahora: float) -> float:
+    restante = payload.get("exp", 0) - time.time()
+    return ahora + max(0, min(TOKEN_CACHE_SECONDS, restante))
+
+_tokens_cache: TLRUCache = TLRUCache(maxsize=8192, ttu=_vigencia_token)
+_tokens_lock = threading.RLock()
+
 # Decodificar access token
-def decodificar_token(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def decodificar_token(token: str = Depends(oauth2_scheme)):
+    with _tokens_lock:
+        payload = _tokens_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SIGNING_KEY, algorithms=[ALGORITHM])
         usuario_id = payload.get("id_usuario")
         if usuario_id is None:
             raise HTTPException(status_code=401, detail="TOKEN_INVALIDO")
     except JWTError:
         raise HTTPException(status_code=401, detail="TOKEN_INVALIDO")
+
+    with _tokens_lock:
+        _tokens_cache[token] = payload
     return payload
 
 def get_current_user(payload: dict = Depends(decodificar_token), db: Session = Depends(get_db)):
@@ -62,6 +150,40 @@ def get_current_user(payload: dict = Depends(decodificar_token), db: Session = D
         raise HTTPException(status_code=404, detail="USUARIO_NO_ENCONTRADO")
     return usuario
 
+# Perfil mínimo del usuario autenticado (cacheado unos segundos por usuario_id)
+class PerfilUsuario(NamedTuple):
+    id: int
+    datos_personales_id: int
+    rol_id: int
+
+_perfiles_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+_perfiles_lock = threading.Lock()
+
+def get_user_profile(db: Session, usuario_id: int) -> PerfilUsuario | None:
+    with _perfiles_lock:
+        perfil = _perfiles_cache.get(usuario_id)
+    if perfil is not None:
+        return perfil
+
+    fila = db.query(Usuario.id, Usuario.datos_personales_id, Usuario.rol_id).filter(
+        Usuario.id == usuario_id,
+        Usuario.activo == True
+    ).first()
+    if not fila:
+        return None
+
+    perfil = PerfilUsuario(*fila)
+    with _perfiles_lock:
+        _perfiles_cache[usuario_id] = perfil
+    return perfil
+
+def get_current_user_perfil(payload: dict = Depends(decodificar_token), db: Session = Depends(get_db)) -> PerfilUsuario:
+    """Como get_current_user, pero sin cargar la entidad Usuario en cada request"""
+    perfil = get_user_profile(db, payload.get("id_usuario"))
+    if not perfil:
+        raise HTTPException(status_code=404, detail="USUARIO_NO_ENCONTRADO")
+    return perfil
+
 # WebSocket authentication - SIMPLIFICADO Y CORREGIDO
 async def get_current_user_ws(websocket: WebSocket, db: Session):
     """
@@ -82,7 +204,7 @@ async def get_current_user_ws(websocket: WebSocket, db: Session):
     try:
         payload = jwt.decode(
             token, 
-            SECRET_KEY, 
+            SIGNING_KEY, 
             algorithms=[ALGORITHM]
         )
         
@@ -1,6 +1,20 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import update, values, column, String, DateTime
+from sqlalchemy.orm import Session, joinedload
+from ..models import Usuario
 from .models import SesionAppUsuario
+from ...database.database import SessionLocal
 from datetime import datetime
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto se escriben en lote las marcas de ultima_actividad
+ACTIVIDAD_FLUSH_SECONDS = 5
+# refresh_token -> última actividad pendiente de guardar
+_actividad_pendiente: dict[str, datetime] = {}
+_actividad_lock = threading.Lock()
 
 def crear_sesion(
     db: Session,
@@ -41,7 +55,10 @@ def inhabilitar_sesion(db: Session, refresh_token: str):
 
 
 def obtener_sesion(db: Session, refresh_token: str):
-    sesion = db.query(SesionAppUsuario).filter_by(refresh_token=refresh_token, activo=True).first()
+    # El refresh usa sesion.usuario y su rol: cargarlos en la misma consulta
+    sesion = db.query(SesionAppUsuario).options(
+        joinedload(SesionAppUsuario.usuario).joinedload(Usuario.rol)
+    ).filter_by(refresh_token=refresh_token, activo=True).first()
     if not sesion:
         return None
     # Solo verificar expiración del refresh token, NO inactividad
@@ -49,4 +66,49 @@ def obtener_sesion(db: Session, refresh_token: str):
         sesion.activo = False
         db.commit()
         return None
-    return sesion
\ No newline at end of file
+    return sesion
+
+
+def registrar_actividad(refresh_token: str):
+    """Marca actividad de la sesión sin escribir en la BD (se guarda en lote)"""
+    with _actividad_lock:
+        _actividad_pendiente[refresh_token] = datetime.utcnow()
+
+
+def _guardar_actividad(pendientes: dict[str, datetime]):
+    db = SessionLocal()
+    try:
+        # Un solo UPDATE ... FROM (VALUES ...): cada sesión recibe su propia marca
+        lote = values(
+            column("refresh_token", String),
+            column("ultima_actividad", DateTime),
+            name="lote"
+        ).data(list(pendientes.items()))
+        db.execute(
+            update(SesionAppUsuario)
+            .where(SesionAppUsuario.refresh_token == lote.c.refresh_token)
+            .values(ultima_actividad=lote.c.ultima_actividad)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def vaciar_actividad():
+    """Guarda ya las marcas de actividad pendientes (también se usa al apagar la app)"""
+    global _actividad_pendiente
+    with _actividad_lock:
+        pendientes, _actividad_pendiente = _actividad_pendiente, {}
+    if pendientes:
+        _guardar_actividad(pendientes)
+
+
+async def vaciar_actividad_periodicamente():
+    """Tarea de fondo (startup): guarda las marcas de actividad cada ACTIVIDAD_FLUSH_SECONDS"""
+    while True:
+        await asyncio.sleep(ACTIVIDAD_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(vaciar_actividad)
+        except Exception as e:
+            logger.error("❌ Error guardando ultima_actividad: %s", e)